@@ -1,15 +1,27 @@
+import time
+
 from lib.llm.basellm import BaseApiLLM
+from lib.llm.deadline import Deadline
 from lib.llm.ollama import OllamaApi # For type hinting
 from lib.llm.openai import OpenAiApi # For type hinting
+from lib.memory import ConversationMemory
+from lib.ledger import UsageLedger
+from lib.singleflight import SingleFlight, request_key
 from lib.utils.text import colorize
+from lib.utils.trace import span
 
 class BaseAgent:
-    def __init__(self, llm_apis: dict[str, BaseApiLLM], default_api_name: str = None):
+    def __init__(self, llm_apis: dict[str, BaseApiLLM], default_api_name: str = None,
+                 single_flight: SingleFlight = None, ledger: UsageLedger = None):
         self.llm_apis: dict[str, BaseApiLLM] = llm_apis
+        self.single_flight: SingleFlight = single_flight # Shares identical in-flight requests when set
+        self.ledger: UsageLedger = ledger # Records every request when set
         self.active_llm_api: BaseApiLLM = None
         self.active_api_name: str = None
         self.message_count: int = 0
         self.token_count: int = 0 # Placeholder for future token counting
+        self.last_response_data: dict = None # Full result of the last request (usage, stop reason)
+        self.memory: ConversationMemory = None # When set, requests without explicit history continue its conversation
 
         if default_api_name and default_api_name in self.llm_apis:
             self.set_active_api(default_api_name)
@@ -33,20 +45,53 @@ class BaseAgent:
     def get_active_api_name(self) -> str:
         return self.active_api_name if self.active_llm_api else "None"
 
-    def generate_response(self, prompt: str, stream: bool = False) -> str | None:
+    def generate_response(self, prompt: str, stream: bool = False, max_tokens: int | None = None,
+                          overflow: str = "truncate", on_token=None, deadline: Deadline = None,
+                          history: list[dict] = None, json_schema: dict | None = None) -> str | None:
         if not self.active_llm_api:
             print("Error: No active LLM API selected.")
             return None
 
-        # LLM API now returns a dictionary
-        llm_response_data = self.active_llm_api.generate_text(prompt, stream=stream)
+        memory = self.memory if history is None else None
+        if memory is not None:
+            with span("agent.memory_window"):
+                history = memory.window(prompt, max_tokens)
 
+        # Check the prompt against the context window before anything is sent
+        with span("agent.fit_prompt"):
+            prompt = self.active_llm_api.fit_prompt(prompt, max_tokens=max_tokens, overflow=overflow, history=history)
+        if prompt is None:
+            return None
+
+        # LLM API now returns a dictionary
+        started = time.perf_counter()
+        try:
+            with span("agent.generate", api=self.active_api_name, model=self.active_llm_api.model_name):
+                # Structured answers are usually stopped early by their caller, that can't be shared
+                if self.single_flight is None or json_schema is not None:
+                    llm_response_data = self.active_llm_api.generate_text(prompt, stream=stream, max_tokens=max_tokens,
+                                                                          on_token=on_token, deadline=deadline,
+                                                                          history=history, json_schema=json_schema)
+                else:
+                    llm_response_data = self._generate_single_flight(prompt, stream, max_tokens, on_token, deadline,
+                                                                     history)
+        except Exception as e:
+            self._record_usage(None, started, error=type(e).__name__)
+            raise
+        self._record_usage(llm_response_data, started)
+
+        self.last_response_data = llm_response_data
         if llm_response_data is None:
             # Handle case where API might fail and return None (e.g. connection error)
             return None
 
         self.message_count += 1
-        self.token_count += llm_response_data.get("total_tokens", 0)
+        if not llm_response_data.get("shared"): # Shared answers cost the server nothing extra
+            self.token_count += llm_response_data.get("total_tokens", 0)
+        if not history and not llm_response_data.get("estimated"): # With history the server only reports uncached tokens
+            self.active_llm_api.calibrate_tokens(prompt, llm_response_data)
+        if memory is not None and llm_response_data.get("text") and llm_response_data.get("stopped") not in ("cancelled", "early"):
+            memory.add_turn(prompt, llm_response_data["text"])
 
         # print(f"DEBUG_AGENT: Generating response with API: {self.active_api_name}") # Removed
         # print(f"DEBUG_AGENT: Prompt passed to LLM: '{prompt[:100]}...'") # Removed
@@ -58,6 +103,56 @@ class BaseAgent:
 
         return llm_response_data.get("text")
 
+    def chat_with_tools(self, messages: list[dict], tools: list[dict], max_tokens: int | None = None,
+                        deadline: Deadline = None) -> dict | None:
+        """One tool-calling turn on the active API, see BaseApiLLM.chat_with_tools."""
+        if not self.active_llm_api:
+            print("Error: No active LLM API selected.")
+            return None
+
+        started = time.perf_counter()
+        try:
+            with span("agent.chat_with_tools", api=self.active_api_name, model=self.active_llm_api.model_name):
+                llm_response_data = self.active_llm_api.chat_with_tools(messages, tools, max_tokens=max_tokens,
+                                                                        deadline=deadline)
+        except Exception as e:
+            self._record_usage(None, started, error=type(e).__name__)
+            raise
+        self._record_usage(llm_response_data, started)
+
+        self.last_response_data = llm_response_data
+        if llm_response_data is not None:
+            self.message_count += 1
+            self.token_count += llm_response_data.get("total_tokens", 0)
+        return llm_response_data
+
+    def _record_usage(self, llm_response_data: dict | None, started: float, error: str | None = None) -> None:
+        if self.ledger is not None:
+            self.ledger.record_result(self.active_api_name, self.active_llm_api, llm_response_data,
+                                      time.perf_counter() - started, error=error)
+
+    def _generate_single_flight(self, prompt: str, stream: bool, max_tokens: int | None, on_token,
+                                deadline: Deadline = None, history: list[dict] = None) -> dict | None:
+        api = self.active_llm_api
+        key = request_key(type(api).__name__, api.base_url, api.model_name, api.params["system_prompt"],
+                          prompt, max_tokens, history)
+
+        # The shared generation always streams so that followers can attach mid-answer;
+        # whether this caller sees the pieces still depends on `stream` / `on_token`.
+        display = on_token
+        if display is None and stream:
+            print() # Start stream on new line
+            display = lambda piece: print(piece, end="", flush=True)
+
+        def generate(publish):
+            return api.generate_text(prompt, stream=True, max_tokens=max_tokens, on_token=publish, deadline=deadline,
+                                     history=history)
+
+        llm_response_data = self.single_flight.do(key, generate, on_token=display, deadline=deadline)
+        if on_token is None and stream:
+            print() # Newline after stream completion
+        return llm_response_data
+
     def print_status(self):
         active_api_name = self.get_active_api_name()
         active_api_str = colorize(active_api_name, "green") if self.active_llm_api else colorize(active_api_name, "red")
@@ -68,6 +163,8 @@ class BaseAgent:
             f"  Messages Sent: {self.message_count}",
             f"  Tokens Used: {self.token_count}"
         ]
+        if self.memory is not None and self.memory.tokens_used:
+            status_lines.append(f"  Tokens Used (summaries): {self.memory.tokens_used}")
         print("\n".join(status_lines))
 
 if __name__ == '__main__':
@@ -83,7 +180,8 @@ if __name__ == '__main__':
         def list_models(self) -> list[str]:
             return [self.model_name, "mock-model-2"]
 
-        def generate_text(self, prompt: str, stream: bool = False, max_tokens: int = 50) -> dict: # Updated mock
+        def generate_text(self, prompt: str, stream: bool = False, max_tokens: int | None = None,
+                          on_token=None, deadline=None, history=None, json_schema=None) -> dict: # Updated mock
             print(f"MockLLM '{self.model_name}' received prompt: '{prompt}'. Stream: {stream}")
             mock_text = f"Mocked response to: {prompt}"
             if stream:
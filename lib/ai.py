@@ -1,4 +1,7 @@
+from lib.utils.trace import tracer, span, PROCESS_START # First, so the import phase can be traced
 import argparse
+import sqlite3
+import time
 # Removed Enum, sys, and some specific local imports that are no longer used directly in main
 # from lib.llm.prompts import explain_terminal, explain_question # No longer used here
 # from lib.utils.text import extract_quoted_text, remove_empty_or_whitespace_strings # No longer used here
@@ -7,6 +10,21 @@ import argparse
 from lib.llm.openai import OpenAiApi
 from lib.llm.ollama import OllamaApi
 from lib.agent import BaseAgent
+from lib.compare import parse_compare_spec, run_compare, print_compare_table
+from lib.singleflight import SingleFlight
+from lib.llm.deadline import Deadline
+from lib.watch import run_watch
+from lib.gateway import Gateway, parse_concurrency, parse_address
+from lib.memory import ConversationMemory
+from lib.chat import run_chat
+from lib.tools import run_agent
+from lib.structured import ask_structured, build_command_prompt, COMMAND_SCHEMA
+from lib.utils.system import get_system_info
+from lib.utils.text import colorize
+from lib.ledger import UsageLedger, usage_report, print_usage_report, GROUP_COLUMNS
+from lib.utils.profiling import run_profiled
+
+IMPORTS_DONE = time.perf_counter()
 
 
 def main():
@@ -18,9 +36,107 @@ def main():
     parser.add_argument('--stream', action='store_true', help='Enable streaming response')
     parser.add_argument('--api', type=str, default='ollama', choices=['ollama', 'openai'],
                         help='Select the AI API to use (ollama or openai)')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='Maximum number of tokens to generate')
+    parser.add_argument('--overflow', default='truncate', choices=['truncate', 'reject'],
+                        help='What to do when the prompt does not fit the model context (default: truncate)')
+    parser.add_argument('--compare', metavar='APIS', default=None,
+                        help='Send the prompt to several APIs at once, e.g. "ollama,openai" or "ollama:llama3:8b,ollama"')
+    parser.add_argument('--layout', default='lines', choices=['lines', 'blocks'],
+                        help='Compare output: interleaved labelled lines or one block per model (default: lines)')
+    parser.add_argument('--single-flight', action='store_true',
+                        help='Share the answer with identical requests already running in other processes')
+    parser.add_argument('--single-flight-dir', metavar='DIR', default=None,
+                        help='Rendezvous directory for --single-flight (implies it; default: a per-user runtime directory)')
+    parser.add_argument('--timeout', metavar='SECONDS', default=None,
+                        help='Request deadline: total seconds ("120") or separate budgets '
+                             '("connect=5,first=30,total=120")')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep watching the -f file and re-ask the prompt with only what changed')
+    parser.add_argument('--debounce', type=float, default=1.0, metavar='SECONDS',
+                        help='With --watch, wait for writes to pause this long before sending (default: 1.0)')
+    parser.add_argument('--trace', metavar='OUT_JSON', default=None,
+                        help='Record per-phase timings to a Chrome trace-event file')
+    parser.add_argument('--profile', action='store_true',
+                        help='Run under cProfile and tracemalloc and write a hot-function/allocation report')
+    parser.add_argument('--profile-out', metavar='REPORT', default=None,
+                        help='Report file for --profile (implies it; default: ai-profile.txt)')
+    parser.add_argument('--serve', nargs='?', const='127.0.0.1:8080', default=None, metavar='HOST:PORT',
+                        help='Run an OpenAI-compatible gateway in front of the APIs (default: 127.0.0.1:8080)')
+    parser.add_argument('--chat', action='store_true',
+                        help='Interactive multi-turn chat (the prompt and -f file, if given, are the first message)')
+    parser.add_argument('--memory-budget', type=int, default=None, metavar='TOKENS',
+                        help='With --chat, tokens of conversation history sent per turn (default: half the context)')
+    parser.add_argument('--summarizer', metavar='API[:MODEL]', default=None,
+                        help='Model that summarizes older turns in --chat, e.g. "ollama:llama3.2:1b" '
+                             '(default: the active API)')
+    parser.add_argument('--command', action='store_true',
+                        help='Only get the shell command for the prompt: printed as soon as it is complete, '
+                             'the rest of the answer is not generated')
+    parser.add_argument('--agent', action='store_true',
+                        help='Let the model run shell commands to carry out the prompt (each batch asks for confirmation)')
+    parser.add_argument('--jobs', type=int, default=4, metavar='N',
+                        help='With --agent, commands run in parallel (default: 4)')
+    parser.add_argument('--command-timeout', type=float, default=30.0, metavar='SECONDS',
+                        help='With --agent, kill a command after this long (default: 30)')
+    parser.add_argument('--max-steps', type=int, default=8, metavar='N',
+                        help='With --agent, model turns allowed (default: 8)')
+    parser.add_argument('--usage', nargs='?', type=int, const=7, default=None, metavar='DAYS',
+                        help='Print request counts, tokens and latency percentiles from the usage ledger '
+                             'for the last DAYS days (default: 7) and exit')
+    parser.add_argument('--usage-by', default='day,model,host', metavar='COLUMNS',
+                        help=f'With --usage, group by these of {",".join(GROUP_COLUMNS)} (default: day,model,host)')
+    parser.add_argument('--no-ledger', action='store_true',
+                        help='Do not record this run in the usage ledger')
+    parser.add_argument('--concurrency', metavar='LIMITS', default=None,
+                        help='With --serve, concurrent requests per API, e.g. "ollama=1,openai=4" (default: 2 each)')
 
     parsed_args = parser.parse_args()
 
+    if parsed_args.watch and not parsed_args.filename:
+        parser.error("--watch requires -f FILE")
+    if parsed_args.timeout:
+        try:
+            Deadline.parse(parsed_args.timeout)
+        except ValueError as e:
+            parser.error(f"invalid --timeout: {e}")
+    if not set(parsed_args.usage_by.split(",")) <= set(GROUP_COLUMNS):
+        parser.error(f"invalid --usage-by, choose from {','.join(GROUP_COLUMNS)}")
+    if parsed_args.concurrency:
+        try:
+            parse_concurrency(parsed_args.concurrency)
+        except ValueError as e:
+            parser.error(f"invalid --concurrency, expected e.g. \"ollama=1,openai=4\" ({e})")
+    if parsed_args.serve:
+        try:
+            parse_address(parsed_args.serve)
+        except ValueError as e:
+            parser.error(f"invalid --serve address: {e}")
+
+    if parsed_args.trace:
+        tracer.enable()
+        tracer.add_span("imports", PROCESS_START, IMPORTS_DONE)
+        tracer.add_span("parse_args", IMPORTS_DONE, time.perf_counter())
+
+    try:
+        if parsed_args.profile or parsed_args.profile_out:
+            run_profiled(lambda: run(parsed_args), parsed_args.profile_out or "ai-profile.txt")
+        else:
+            run(parsed_args)
+    finally:
+        if parsed_args.trace:
+            tracer.write(parsed_args.trace)
+            print(f"Trace written to {parsed_args.trace}")
+
+
+def run(parsed_args):
+    if parsed_args.usage is not None:
+        group_by = tuple(parsed_args.usage_by.split(","))
+        with span("usage_report"):
+            report = usage_report(days=parsed_args.usage, group_by=group_by)
+        print_usage_report(report, group_by)
+        return
+
     # Print parsed arguments (optional, for debugging)
     # print("[AI] ------------------ parameters: ")
     # print(f"Prompt: {parsed_args.prompt}")
@@ -37,8 +153,9 @@ def main():
 
     # Create API instances
     try:
-        ollama_api = OllamaApi(llm_configs["ollama"]["base_url"], llm_configs["ollama"]["model"])
-        openai_api = OpenAiApi(llm_configs["openai"]["base_url"], llm_configs["openai"]["model"])
+        with span("init_apis"):
+            ollama_api = OllamaApi(llm_configs["ollama"]["base_url"], llm_configs["ollama"]["model"])
+            openai_api = OpenAiApi(llm_configs["openai"]["base_url"], llm_configs["openai"]["model"])
     except Exception as e:
         print(f"Error initializing LLM APIs: {e}")
         return
@@ -49,17 +166,52 @@ def main():
     }
 
     # Instantiate the agent
-    agent = BaseAgent(available_llms, default_api_name=parsed_args.api)
+    single_flight = None
+    if parsed_args.single_flight or parsed_args.single_flight_dir:
+        single_flight = SingleFlight(parsed_args.single_flight_dir)
+    ledger = None
+    if not parsed_args.no_ledger:
+        try:
+            ledger = UsageLedger()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Warning: usage ledger unavailable, not recording this run: {e}")
+    agent = BaseAgent(available_llms, default_api_name=parsed_args.api, single_flight=single_flight, ledger=ledger)
     if not agent.active_llm_api:
         print(f"Failed to activate API: {parsed_args.api}. Please check configurations.")
         return
     
     agent.set_active_api("openai")
 
+    if parsed_args.serve:
+        gateway = Gateway(agent, parse_concurrency(parsed_args.concurrency))
+        gateway.serve(*parse_address(parsed_args.serve))
+        agent.print_status()
+        return
+
+    if parsed_args.chat:
+        summarizer = None
+        summarizer_name = agent.active_api_name
+        if parsed_args.summarizer:
+            resolved = parse_compare_spec(parsed_args.summarizer, available_llms)
+            if not resolved:
+                return
+            summarizer = resolved[0][1]
+            summarizer_name = parsed_args.summarizer.partition(":")[0]
+        agent.memory = ConversationMemory(agent.active_llm_api, summarizer=summarizer,
+                                          budget=parsed_args.memory_budget, ledger=agent.ledger,
+                                          summarizer_name=summarizer_name)
+
+    if parsed_args.watch:
+        run_watch(agent, parsed_args.filename, parsed_args.prompt, stream=parsed_args.stream,
+                  max_tokens=parsed_args.max_tokens, overflow=parsed_args.overflow,
+                  timeout=parsed_args.timeout, debounce=parsed_args.debounce)
+        agent.print_status()
+        return
+
     file_content = ""
     if parsed_args.filename:
         try:
-            with open(parsed_args.filename, 'r') as f:
+            with span("read_file", path=parsed_args.filename), open(parsed_args.filename, 'r') as f:
                 file_content = f.read()
             print(f"--- Content from {parsed_args.filename} prepended to prompt ---")
         except FileNotFoundError:
@@ -74,6 +226,12 @@ def main():
         else: # Only file content
             final_prompt = file_content
 
+    if parsed_args.chat:
+        run_chat(agent, final_prompt, stream=parsed_args.stream, max_tokens=parsed_args.max_tokens,
+                 overflow=parsed_args.overflow, timeout=parsed_args.timeout)
+        agent.print_status()
+        return
+
     # Ensure final_prompt is not just whitespace
     if not final_prompt.strip():
         if parsed_args.filename and not file_content: # File was specified but could not be read
@@ -82,13 +240,52 @@ def main():
             print("Prompt is empty. Use -h for help or provide a prompt/file.")
         return
 
+    if parsed_args.command:
+        def print_field(name, value):
+            if name == "command":
+                print(colorize(value, "green"), flush=True)
+
+        prompt = build_command_prompt(agent.active_llm_api, final_prompt, get_system_info(),
+                                      max_tokens=parsed_args.max_tokens, overflow=parsed_args.overflow)
+        if prompt is None:
+            return
+        answer = ask_structured(agent, prompt, COMMAND_SCHEMA, stop_after=("command",), on_field=print_field,
+                                max_tokens=parsed_args.max_tokens, overflow=parsed_args.overflow,
+                                timeout=parsed_args.timeout)
+        if answer is not None and "command" not in answer:
+            print("Error: the answer did not contain a command.")
+        return
+
+    if parsed_args.agent:
+        run_agent(agent, final_prompt, max_steps=parsed_args.max_steps, jobs=parsed_args.jobs,
+                  command_timeout=parsed_args.command_timeout, max_tokens=parsed_args.max_tokens,
+                  timeout=parsed_args.timeout)
+        agent.print_status()
+        return
+
+    if parsed_args.compare:
+        compared_apis = parse_compare_spec(parsed_args.compare, available_llms)
+        if not compared_apis:
+            return
+        print(f"\nComparing: {', '.join(label for label, _ in compared_apis)}")
+        results = run_compare(compared_apis, final_prompt, max_tokens=parsed_args.max_tokens,
+                              overflow=parsed_args.overflow, layout=parsed_args.layout,
+                              deadline=Deadline.parse(parsed_args.timeout) if parsed_args.timeout else None,
+                              ledger=agent.ledger)
+        print_compare_table(results)
+        return
+
     print(f"\nUsing API: {agent.get_active_api_name()}")
-    print(f"Sending prompt (length: {len(final_prompt)} chars)...")
+    print(f"Sending prompt (length: {len(final_prompt)} chars, ~{agent.active_llm_api.count_tokens(final_prompt)} tokens)...")
     # For brevity, you might choose to print only a part of a very long prompt
     # print(f"Prompt content: \n{final_prompt[:200]}{'...' if len(final_prompt) > 200 else ''}\n")
 
 
-    response = agent.generate_response(final_prompt, stream=parsed_args.stream)
+    # The deadline clock starts here, just before the request is sent
+    deadline = Deadline.parse(parsed_args.timeout) if parsed_args.timeout else None
+    response = agent.generate_response(final_prompt, stream=parsed_args.stream,
+                                       max_tokens=parsed_args.max_tokens, overflow=parsed_args.overflow,
+                                       deadline=deadline)
 
     # If not streaming, and response is actual text (not None), print it.
     # If streaming, generate_response in BaseAgent handles printing chunks.
@@ -0,0 +1,40 @@
+from lib.agent import BaseAgent
+from lib.llm.deadline import Deadline
+from lib.utils.text import colorize
+
+
+def run_chat(agent: BaseAgent, first_prompt: str = "", stream: bool = False, max_tokens: int | None = None,
+             overflow: str = "truncate", timeout: str | None = None) -> None:
+    """
+    Interactive multi-turn chat on the agent's memory.
+
+    Each turn sends only the memory window (summary plus recent turns) along with
+    the new message, so the prompt stays about the same size however long the
+    session runs. Stops on an empty line "exit", Ctrl-D or Ctrl-C.
+
+    Args:
+        agent (BaseAgent): Agent with the API to use already active and a memory set.
+        first_prompt (str): Sent as the first message if not empty.
+        stream, max_tokens, overflow: As for BaseAgent.generate_response.
+        timeout (str | None): --timeout spec, applied to each turn separately.
+    """
+    print(colorize("[chat] type 'exit' or press Ctrl-D to quit", "blue"))
+    prompt = first_prompt
+    while True:
+        if not prompt.strip():
+            try:
+                prompt = input(colorize("\nyou> ", "green"))
+            except (EOFError, KeyboardInterrupt):
+                print()
+                return
+            if prompt.strip() == "exit":
+                return
+            if not prompt.strip():
+                continue
+
+        deadline = Deadline.parse(timeout) if timeout else None
+        response = agent.generate_response(prompt, stream=stream, max_tokens=max_tokens, overflow=overflow,
+                                           deadline=deadline)
+        if response and not stream:
+            print(f"\nAI Response:\n{response}")
+        prompt = ""
@@ -0,0 +1,165 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.llm.basellm import BaseApiLLM
+from lib.ledger import UsageLedger
+from lib.llm.deadline import Deadline
+from lib.utils.text import colorize
+
+PANE_COLORS = ["green", "blue", "yellow", "red"]
+
+
+class CompareResult:
+    """Answer and timings of one backend in a compare run."""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.text = ""
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.ttft = None  # seconds until the first token
+        self.duration = 0.0  # seconds until the answer was complete
+        self.error = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        generating = self.duration - (self.ttft or 0.0)
+        if self.completion_tokens and generating > 0:
+            return self.completion_tokens / generating
+        return 0.0
+
+
+def parse_compare_spec(spec: str, llm_apis: dict[str, BaseApiLLM]) -> list[tuple[str, BaseApiLLM]]:
+    """
+    Resolves a compare spec like "ollama,openai" or "ollama:llama3:8b,openai" to API instances.
+
+    An optional ":model" after the API name runs that model on the same backend.
+
+    Returns:
+        list[tuple[str, BaseApiLLM]]: (label, api) pairs, or an empty list if an API name is unknown.
+    """
+    selected = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        api_name, _, model = entry.partition(":")
+        if api_name not in llm_apis:
+            print(f"Error: API '{api_name}' not found in available LLMs.")
+            return []
+        api = llm_apis[api_name]
+        if model and model != api.model_name:
+            base_api = api
+            api = type(base_api)(base_api.base_url, model)
+            api.set_params({"system_prompt": base_api.params["system_prompt"]})
+        selected.append((f"{api_name}:{api.model_name}", api))
+    return selected
+
+
+def run_compare(apis: list[tuple[str, BaseApiLLM]], prompt: str, max_tokens: int | None = None,
+                overflow: str = "truncate", layout: str = "lines", deadline: Deadline = None,
+                ledger: UsageLedger = None) -> list[CompareResult]:
+    """
+    Sends the same prompt to several backends at once and renders their streams.
+
+    Args:
+        apis: (label, api) pairs as returned by parse_compare_spec.
+        prompt (str): The prompt sent to every backend.
+        max_tokens (int | None): Generation limit applied to every backend.
+        overflow (str): Context overflow policy, see BaseApiLLM.fit_prompt.
+        layout (str): "lines" prints every backend's output line by line as it arrives,
+            prefixed with its label; "blocks" prints each full answer when it completes.
+        deadline (Deadline, optional): Time budgets shared by all backends.
+        ledger (UsageLedger, optional): Records every backend's request.
+
+    Returns:
+        list[CompareResult]: One result per backend, in the order given.
+    """
+    print_lock = threading.Lock()
+    width = max(len(label) for label, _ in apis)
+
+    def run_one(index: int, label: str, api: BaseApiLLM) -> CompareResult:
+        result = CompareResult(label)
+        color = PANE_COLORS[index % len(PANE_COLORS)]
+        prefix = colorize(f"[{label.ljust(width)}]", color)
+        pending = [""]  # partial line not printed yet (lines layout)
+
+        def on_token(piece: str):
+            if result.ttft is None:
+                result.ttft = time.perf_counter() - start
+            if layout != "lines":
+                return
+            pending[0] += piece
+            if "\n" in pending[0]:
+                *lines, pending[0] = pending[0].split("\n")
+                with print_lock:
+                    for line in lines:
+                        print(f"{prefix} {line}", flush=True)
+
+        start = time.perf_counter()
+        fitted = api.fit_prompt(prompt, max_tokens=max_tokens, overflow=overflow)
+        if fitted is None:
+            result.error = "prompt too long"
+            return result
+        sent = time.perf_counter()
+        error = None
+        try:
+            data = api.generate_text(fitted, stream=True, max_tokens=max_tokens, on_token=on_token, deadline=deadline)
+        except Exception as e:
+            result.error = str(e)
+            error = type(e).__name__
+            data = None
+        result.duration = time.perf_counter() - start
+        if ledger is not None:
+            ledger.record_result(label.partition(":")[0], api, data, time.perf_counter() - sent, error=error)
+
+        if data:
+            result.text = data.get("text", "")
+            result.prompt_tokens = data.get("prompt_tokens", 0)
+            result.completion_tokens = data.get("completion_tokens", 0) or api.count_tokens(result.text)
+            if data.get("stopped"):
+                result.error = data["stopped"]
+            elif not result.text and result.error is None:
+                result.error = "empty response"
+
+        with print_lock:
+            if layout == "lines":
+                if pending[0]:
+                    print(f"{prefix} {pending[0]}", flush=True)
+                print(f"{prefix} {colorize('-- done --', color)}", flush=True)
+            else:
+                print(colorize(f"\n===== {label} =====", color))
+                print(result.text if result.text else colorize(f"(no answer: {result.error})", "red"), flush=True)
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(apis)) as pool:
+        futures = [pool.submit(run_one, i, label, api) for i, (label, api) in enumerate(apis)]
+        return [future.result() for future in futures]
+
+
+def print_compare_table(results: list[CompareResult]) -> None:
+    """Prints TTFT, throughput and token counts of a compare run as a table."""
+    headers = ["Model", "TTFT (s)", "Total (s)", "Tokens/s", "Prompt tok", "Output tok", "Total tok"]
+    rows = []
+    for r in results:
+        rows.append([
+            r.label,
+            f"{r.ttft:.2f}" if r.ttft is not None else "-",
+            f"{r.duration:.2f}",
+            f"{r.tokens_per_second:.1f}" if r.tokens_per_second else "-",
+            str(r.prompt_tokens),
+            str(r.completion_tokens),
+            str(r.prompt_tokens + r.completion_tokens),
+        ])
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+
+    def fmt(cells):
+        return "  ".join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(cells, widths)))
+
+    print()
+    print(fmt(headers))
+    print("  ".join("-" * w for w in widths))
+    for r, row in zip(results, rows):
+        line = fmt(row)
+        print(colorize(line, "red") if r.error else line)
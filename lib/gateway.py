@@ -0,0 +1,453 @@
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from lib.agent import BaseAgent
+from lib.llm.basellm import BaseApiLLM
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+DEFAULT_CONCURRENCY = 2
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+
+
+class _Ticket:
+    __slots__ = ("client", "priority", "seq", "queued_at")
+
+    def __init__(self, client: str, priority: int, seq: int):
+        self.client = client
+        self.priority = priority
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+
+class Scheduler:
+    """
+    Admits requests to each backend up to its concurrency limit.
+
+    Waiting requests are admitted by priority first (interactive before batch),
+    then fair-share: the client with the fewest requests running on that backend,
+    then the fewest admitted so far, and finally arrival order.
+    """
+
+    def __init__(self, concurrency: dict[str, int]):
+        self.concurrency = concurrency
+        self.cond = threading.Condition()
+        self.waiting: dict[str, list[_Ticket]] = {name: [] for name in concurrency}
+        self.running: dict[str, int] = {name: 0 for name in concurrency}
+        self.client_running: dict[tuple[str, str], int] = {}
+        self.client_served: dict[tuple[str, str], int] = {}
+        self.seq = 0
+        # Metrics
+        self.completed: dict[str, int] = {name: 0 for name in concurrency}
+        self.peak_queue: dict[str, int] = {name: 0 for name in concurrency}
+        self.waits: dict[str, deque] = {name: deque(maxlen=1000) for name in concurrency}
+
+    def _best(self, backend: str) -> _Ticket:
+        return min(self.waiting[backend], key=lambda t: (
+            t.priority,
+            self.client_running.get((backend, t.client), 0),
+            self.client_served.get((backend, t.client), 0),
+            t.seq,
+        ))
+
+    def acquire(self, backend: str, client: str, priority: str = "interactive") -> float:
+        """Blocks until the request may run on `backend`; returns the seconds it waited."""
+        with self.cond:
+            self.seq += 1
+            ticket = _Ticket(client, PRIORITIES.get(priority, 0), self.seq)
+            queue = self.waiting[backend]
+            queue.append(ticket)
+            self.peak_queue[backend] = max(self.peak_queue[backend], len(queue))
+            while not (self.running[backend] < self.concurrency[backend] and self._best(backend) is ticket):
+                self.cond.wait()
+            queue.remove(ticket)
+            key = (backend, client)
+            self.running[backend] += 1
+            self.client_running[key] = self.client_running.get(key, 0) + 1
+            self.client_served[key] = self.client_served.get(key, 0) + 1
+            waited = time.monotonic() - ticket.queued_at
+            self.waits[backend].append(waited)
+            # Another slot may still be free for the next waiter
+            self.cond.notify_all()
+            return waited
+
+    def release(self, backend: str, client: str) -> None:
+        with self.cond:
+            key = (backend, client)
+            self.running[backend] -= 1
+            self.client_running[key] -= 1
+            self.completed[backend] += 1
+            self.cond.notify_all()
+
+    def metrics(self) -> dict:
+        with self.cond:
+            result = {}
+            for backend in self.concurrency:
+                waits = sorted(self.waits[backend])
+                result[backend] = {
+                    "concurrency": self.concurrency[backend],
+                    "running": self.running[backend],
+                    "queue_depth": len(self.waiting[backend]),
+                    "queue_depth_by_priority": {
+                        name: sum(1 for t in self.waiting[backend] if t.priority == level)
+                        for name, level in PRIORITIES.items()
+                    },
+                    "peak_queue_depth": self.peak_queue[backend],
+                    "completed": self.completed[backend],
+                    "wait_ms": {
+                        "avg": 1000 * sum(waits) / len(waits) if waits else 0.0,
+                        "p50": 1000 * _percentile(waits, 0.50),
+                        "p95": 1000 * _percentile(waits, 0.95),
+                        "max": 1000 * waits[-1] if waits else 0.0,
+                    },
+                }
+            return result
+
+
+def _percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Gateway:
+    """
+    Local OpenAI-compatible HTTP gateway in front of an agent's backends.
+
+    All clients share the backends' pooled connections, and the Scheduler
+    decides who runs when a backend is at its concurrency limit.
+
+    Endpoints:
+        POST /v1/chat/completions   OpenAI chat completions (streamed or not)
+        GET  /v1/models             "<api>/<model>" for every configured backend
+        GET  /metrics               scheduler queue depth and wait time metrics (JSON)
+
+    Clients pick a backend with the model name ("ollama/devstral:latest", "ollama",
+    or a bare model name of a backend; any other name is a 404), their priority with an
+    `X-Priority: interactive|batch` header, and identify themselves for fair-share
+    with `X-Client-Id` (the client address otherwise).
+    """
+
+    def __init__(self, agent: BaseAgent, concurrency: dict[str, int] | None = None):
+        self.agent = agent
+        concurrency = concurrency or {}
+        self.scheduler = Scheduler({name: concurrency.get(name, DEFAULT_CONCURRENCY) for name in agent.llm_apis})
+        self.models: dict[tuple[str, str], BaseApiLLM] = {}  # extra models on a configured backend
+        self.lock = threading.Lock()
+
+    def resolve(self, model: str | None) -> tuple[str, BaseApiLLM] | None:
+        """Maps a requested model name to (api name, api instance), or None if no backend serves it."""
+        apis = self.agent.llm_apis
+        if not model:
+            return self.agent.active_api_name, self.agent.active_llm_api
+        api_name, sep, model_name = model.partition("/")
+        if sep and api_name in apis:
+            if not model_name or model_name == apis[api_name].model_name:
+                return api_name, apis[api_name]
+            with self.lock:
+                key = (api_name, model_name)
+                if key not in self.models:
+                    base_api = apis[api_name]
+                    self.models[key] = type(base_api)(base_api.base_url, model_name)
+                    self.models[key].set_params({"system_prompt": base_api.params["system_prompt"]})
+                return api_name, self.models[key]
+        if model in apis:
+            return model, apis[model]
+        for api_name, api in apis.items():
+            if api.model_name == model:
+                return api_name, api
+        return None
+
+    def list_models(self) -> dict:
+        data = [{"id": f"{name}/{api.model_name}", "object": "model", "created": 0, "owned_by": name}
+                for name, api in self.agent.llm_apis.items()]
+        return {"object": "list", "data": data}
+
+    def record(self, api_name: str, api: BaseApiLLM, result: dict | None, duration: float) -> None:
+        error = result.get("error") if result else "client_disconnected"
+        if self.agent.ledger is not None:
+            self.agent.ledger.record(api_name, api.model_name, api.base_url, result, duration, error=error)
+        if error:
+            return
+        with self.lock:
+            self.agent.message_count += 1
+            self.agent.token_count += result.get("total_tokens", 0)
+
+    def make_server(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+        """HTTP server for this gateway, bound but not yet serving (port 0 picks a free port)."""
+        gateway = self
+
+        class Handler(_GatewayHandler):
+            pass
+
+        Handler.gateway = gateway
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        return server
+
+    def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        server = self.make_server(host, port)
+        print(f"Gateway listening on http://{host}:{port}/v1 "
+              f"({', '.join(f'{n}: {c}' for n, c in self.scheduler.concurrency.items())} concurrent)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nGateway stopped.")
+        finally:
+            server.server_close()
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    gateway: Gateway = None
+    responded = False  # set once a status line was sent, after which errors can't be reported
+
+    def log_message(self, format, *args):
+        pass  # one line per request is printed by do_POST instead
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.responded = True
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, message: str, code: str = "invalid_request_error") -> None:
+        self._send_json(status, {"error": {"message": message, "type": code}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, self.gateway.list_models())
+        elif self.path.rstrip("/") == "/metrics":
+            self._send_json(200, self.gateway.scheduler.metrics())
+        else:
+            self._error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        try:
+            self._chat_completions()
+        except Exception as e:
+            # Answer with an error instead of dropping the connection
+            print(f"[gateway] {self.client_address[0]} {self.path}: unexpected error: {e!r}")
+            if not self.responded:
+                try:
+                    self._error(500, f"Internal error: {type(e).__name__}", "server_error")
+                except OSError:
+                    pass
+
+    def _chat_completions(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._error(404, f"Unknown path {self.path}")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self._error(400, "Body must be JSON")
+            return
+        try:
+            messages, max_tokens = _parse_request(body)
+        except ValueError as e:
+            self._error(400, str(e))
+            return
+        if not messages or messages[-1]["role"] != "user":
+            self._error(400, "The last message must be a user message")
+            return
+
+        gateway = self.gateway
+        resolved = gateway.resolve(body.get("model"))
+        if resolved is None:
+            self._error(404, f"The model '{body.get('model')}' does not exist", "model_not_found")
+            return
+        api_name, api = resolved
+        client = self.headers.get("X-Client-Id") or self.client_address[0]
+        priority = self.headers.get("X-Priority", "interactive").lower()
+        history = messages[:-1]
+        prompt = messages[-1]["content"]
+        stream = bool(body.get("stream"))
+
+        if api.fit_prompt(prompt, max_tokens=max_tokens, overflow="reject", history=history) is None:
+            self._error(400, f"Messages do not fit the context of {api.model_name}", "context_length_exceeded")
+            return
+
+        waited = gateway.scheduler.acquire(api_name, client, priority)
+        started = time.monotonic()
+        try:
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            model_id = f"{api_name}/{api.model_name}"
+            if stream:
+                result = self._stream(api_name, api, prompt, history, max_tokens, completion_id, model_id,
+                                      include_usage=bool((body.get("stream_options") or {}).get("include_usage")))
+            else:
+                result = api.generate_text(prompt, stream=False, max_tokens=max_tokens, history=history)
+                if result.get("error"):
+                    self._backend_error(api_name, result["error"])
+                else:
+                    self._send_json(200, _completion(completion_id, model_id, result))
+        finally:
+            gateway.scheduler.release(api_name, client)
+        duration = time.monotonic() - started
+        gateway.record(api_name, api, result, duration)
+        if not result:
+            outcome = "client disconnected"
+        elif result.get("error"):
+            outcome = f"backend error {result['error']}"
+        else:
+            outcome = f"{result.get('total_tokens', 0)} tokens"
+        print(f"[gateway] {client} {priority} {api_name}/{api.model_name}: waited {waited * 1000:.0f} ms, "
+              f"ran {duration * 1000:.0f} ms, {outcome}")
+
+    def _backend_error(self, api_name: str, error: str) -> None:
+        self._error(502, f"The '{api_name}' backend failed: {error}", "backend_error")
+
+    def _stream(self, api_name: str, api: BaseApiLLM, prompt: str, history: list[dict], max_tokens,
+                completion_id: str, model_id: str, include_usage: bool) -> dict | None:
+        def start():
+            # Headers go out with the first piece, so a backend that fails before it still gets a 502
+            if self.responded:
+                return
+            self.responded = True
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            send(_chunk(completion_id, model_id, {"role": "assistant"}))
+
+        def send(payload: dict | str):
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        disconnected = []
+
+        def on_token(piece: str):
+            # A client that went away raises here, which closes the backend stream too
+            try:
+                start()
+                send(_chunk(completion_id, model_id, {"content": piece}))
+            except OSError:
+                disconnected.append(True)
+                raise
+
+        try:
+            result = api.generate_text(prompt, stream=True, max_tokens=max_tokens, on_token=on_token,
+                                       history=history)
+            if disconnected:
+                return None
+            if result.get("error"):
+                if not self.responded:
+                    self._backend_error(api_name, result["error"])
+                    return result
+                # Already streaming: end it with an error event, as OpenAI does
+                send({"error": {"message": f"The '{api_name}' backend failed: {result['error']}", "type": "backend_error"}})
+                send("[DONE]")
+                return result
+            start()
+            finish = "length" if max_tokens and result.get("completion_tokens", 0) >= max_tokens else "stop"
+            send(_chunk(completion_id, model_id, {}, finish_reason=finish))
+            if include_usage:
+                send({**_chunk(completion_id, model_id, None), "usage": _usage(result)})
+            send("[DONE]")
+            return result
+        except OSError:  # the client disconnected
+            return None
+
+
+def _parse_request(body) -> tuple[list[dict], int | None]:
+    """
+    Validates a chat completions body.
+
+    Returns:
+        tuple[list[dict], int | None]: The messages as {"role", "content"} with text
+            content, and the max_tokens limit.
+
+    Raises:
+        ValueError: With a message for the client if the body is malformed.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("messages"), list):
+        raise ValueError("Body must be JSON with a 'messages' list")
+    messages = []
+    for i, message in enumerate(body["messages"]):
+        if not isinstance(message, dict) or not isinstance(message.get("role"), str):
+            raise ValueError(f"messages[{i}] must be an object with a 'role'")
+        content = message.get("content")
+        if isinstance(content, list):
+            # Content parts: only text is supported, joined into one string
+            if not all(isinstance(part, dict) and part.get("type") == "text" and isinstance(part.get("text"), str)
+                       for part in content):
+                raise ValueError(f"messages[{i}].content parts must all be text parts")
+            content = "".join(part["text"] for part in content)
+        elif content is None:
+            content = ""
+        elif not isinstance(content, str):
+            raise ValueError(f"messages[{i}].content must be a string or a list of text parts")
+        messages.append({"role": message["role"], "content": content})
+
+    max_tokens = body.get("max_tokens")
+    if max_tokens is None:
+        max_tokens = body.get("max_completion_tokens")
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1):
+        raise ValueError("max_tokens must be a positive integer")
+    return messages, max_tokens
+
+
+def _usage(result: dict) -> dict:
+    return {"prompt_tokens": result.get("prompt_tokens", 0),
+            "completion_tokens": result.get("completion_tokens", 0),
+            "total_tokens": result.get("total_tokens", 0)}
+
+
+def _chunk(completion_id: str, model_id: str, delta: dict | None, finish_reason: str | None = None) -> dict:
+    choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": model_id, "choices": choices}
+
+
+def _completion(completion_id: str, model_id: str, result: dict) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_id,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": result.get("text", "")}}],
+        "usage": _usage(result),
+    }
+
+
+def parse_concurrency(spec: str | None) -> dict[str, int]:
+    """
+    Parses "ollama=2,openai=4" into {"ollama": 2, "openai": 4}.
+
+    Raises:
+        ValueError: If a limit is not a whole number of at least 1.
+    """
+    concurrency = {}
+    for part in (spec or "").split(","):
+        if part.strip():
+            name, _, value = part.partition("=")
+            limit = int(value)
+            if limit < 1:
+                raise ValueError(f"the limit of '{name.strip()}' must be at least 1")
+            concurrency[name.strip()] = limit
+    return concurrency
+
+
+def parse_address(spec: str) -> tuple[str, int]:
+    """
+    Parses a --serve address: "HOST:PORT", "HOST:", ":PORT" or "PORT".
+
+    Raises:
+        ValueError: If the port is not a number between 1 and 65535.
+    """
+    host, _, port = spec.rpartition(":")
+    host = host.strip("[]") or DEFAULT_HOST  # "[::1]:8080"
+    port = int(port) if port else DEFAULT_PORT
+    if not 1 <= port <= 65535:
+        raise ValueError(f"port {port} is out of range")
+    return host, port
@@ -0,0 +1,331 @@
+import atexit
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+# Latency histograms use log-spaced buckets: bucket b holds values in
+# [BUCKET_BASE**b, BUCKET_BASE**(b+1)) milliseconds, so percentiles read from
+# them are within ~5% of the exact value.
+BUCKET_BASE = 1.1
+
+GROUP_COLUMNS = ("day", "backend", "model", "host")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    model TEXT NOT NULL,
+    host TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    ttft_ms REAL,
+    duration_ms REAL NOT NULL,
+    cache_hit INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_day ON requests (day, model, host);
+
+CREATE TABLE IF NOT EXISTS daily (
+    day TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    model TEXT NOT NULL,
+    host TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    duration_ms REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, backend, model, host)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS latency (
+    day TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    model TEXT NOT NULL,
+    host TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, backend, model, host, metric, bucket)
+) WITHOUT ROWID;
+"""
+
+UPSERT_DAILY = """
+INSERT INTO daily (day, backend, model, host, requests, errors, cache_hits, prompt_tokens, completion_tokens, duration_ms)
+VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+ON CONFLICT (day, backend, model, host) DO UPDATE SET
+    requests = requests + 1,
+    errors = errors + excluded.errors,
+    cache_hits = cache_hits + excluded.cache_hits,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    completion_tokens = completion_tokens + excluded.completion_tokens,
+    duration_ms = duration_ms + excluded.duration_ms
+"""
+
+UPSERT_LATENCY = """
+INSERT INTO latency (day, backend, model, host, metric, bucket, count) VALUES (?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (day, backend, model, host, metric, bucket) DO UPDATE SET count = count + 1
+"""
+
+
+def default_ledger_path() -> str:
+    """Location of the usage ledger, shared by every `ai` process of the user."""
+    if os.environ.get("AGENT_TERMINAL_LEDGER"):
+        return os.environ["AGENT_TERMINAL_LEDGER"]
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "agent-terminal", "usage.db")
+
+
+def host_of(base_url: str) -> str:
+    """ "http://10.1.1.62:11434" -> "10.1.1.62:11434" """
+    parsed = urlparse(base_url)
+    return parsed.netloc or base_url
+
+
+def bucket_of(ms: float) -> int:
+    return int(math.log(max(ms, 1.0), BUCKET_BASE))
+
+
+def bucket_value(bucket: int) -> float:
+    """Representative value (geometric middle) of a histogram bucket, in ms."""
+    return BUCKET_BASE ** (bucket + 0.5)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=10.0, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")  # readers (ai --usage) never block the writers
+    conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; a crash may lose the last batch only
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class UsageLedger:
+    """
+    Append-only SQLite record of every request, with daily rollups for fast queries.
+
+    record() only puts the row on a queue; a background thread writes the queue
+    in batches, one transaction per batch, so requests never wait on the disk.
+    Each batch also updates the per day/backend/model/host totals (`daily`) and
+    latency histograms (`latency`), which is what `ai --usage` reads: its
+    queries touch a few rows per group however many requests are stored.
+    Pending rows are all written by close(), which also runs when the process exits.
+    """
+
+    BATCH_SIZE = 500
+    BATCH_WAIT = 0.2  # seconds the writer waits to grow a batch
+
+    def __init__(self, path: str | None = None):
+        self.path = path or default_ledger_path()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.conn = connect(self.path)
+        self.closed = False
+        self.close_lock = threading.Lock()
+        self.dropped = 0  # rows lost to write errors
+        self.writer = threading.Thread(target=self._write_loop, name="usage-ledger", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def record(self, backend: str, model: str, base_url: str, result: dict | None, duration: float,
+               error: str | None = None, ts: float | None = None) -> None:
+        """
+        Queues one request for writing.
+
+        Args:
+            backend (str): API name, e.g. "ollama".
+            model (str): Model name.
+            base_url (str): Server the request went to.
+            result (dict | None): What generate_text returned (None if it failed).
+            duration (float): Seconds from sending the request to the end of the answer.
+            error (str, optional): Error class, e.g. "timeout", "cancelled" or an exception name.
+                Defaults to the result's own "error", then to how it stopped.
+        """
+        ts = ts or time.time()
+        result = result or {}
+        ttft = result.get("ttft")
+        self.queue.put((
+            ts,
+            time.strftime("%Y-%m-%d", time.localtime(ts)),
+            backend,
+            model,
+            host_of(base_url),
+            result.get("prompt_tokens", 0),
+            result.get("completion_tokens", 0),
+            ttft * 1000 if ttft is not None else None,
+            duration * 1000,
+            1 if result.get("shared") else 0,
+            error or result.get("error") or (result.get("stopped") if result.get("stopped") != "early" else None),
+        ))
+
+    def record_result(self, backend: str, api, result: dict | None, duration: float,
+                      error: str | None = None) -> None:
+        """
+        record() for a request made through `api` (a BaseApiLLM), counting a missing
+        answer as "no_response" and an empty one as "empty_response".
+        """
+        if result is None and error is None:
+            error = "no_response"
+        elif (result is not None and not error and not result.get("error")
+              and not result.get("text") and not result.get("tool_calls")):
+            error = "empty_response"
+        self.record(backend, api.model_name, api.base_url, result, duration, error=error)
+
+    def close(self) -> None:
+        """Writes everything still queued, then stops the writer."""
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(None)
+        self.writer.join()
+        # Rows other threads recorded while closing are behind the stop marker
+        leftover = []
+        while True:
+            try:
+                row = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                leftover.append(row)
+        if leftover:
+            self._write_batch(leftover)
+        self.conn.close()
+        if self.dropped:
+            print(f"Warning: {self.dropped} request(s) could not be written to the usage ledger {self.path}")
+
+    def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.BATCH_WAIT
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [row for row in batch if row is not None]
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, rows: list[tuple]) -> None:
+        try:
+            self._write(rows)
+        except sqlite3.Error as e:
+            self.dropped += len(rows)
+            print(f"Warning: could not write the usage ledger {self.path}: {e}")
+
+    def _write(self, rows: list[tuple]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO requests (ts, day, backend, model, host, prompt_tokens, completion_tokens, "
+                "ttft_ms, duration_ms, cache_hit, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany(UPSERT_DAILY, [
+                (day, backend, model, host, 1 if error else 0, cache_hit, prompt, completion, duration)
+                for _, day, backend, model, host, prompt, completion, _, duration, cache_hit, error in rows
+            ])
+            latency = []
+            for _, day, backend, model, host, _, _, ttft, duration, cache_hit, _ in rows:
+                latency.append((day, backend, model, host, "duration", bucket_of(duration)))
+                if ttft is not None and not cache_hit:
+                    latency.append((day, backend, model, host, "ttft", bucket_of(ttft)))
+            self.conn.executemany(UPSERT_LATENCY, latency)
+
+
+def _percentiles(histogram: list[tuple[int, int]], fractions: tuple[float, ...]) -> list[float | None]:
+    """Percentiles from sorted (bucket, count) pairs."""
+    total = sum(count for _, count in histogram)
+    if not total:
+        return [None] * len(fractions)
+    values = []
+    for fraction in fractions:
+        rank = fraction * total
+        seen = 0
+        for bucket, count in histogram:
+            seen += count
+            if seen >= rank:
+                values.append(bucket_value(bucket))
+                break
+    return values
+
+
+def usage_report(path: str | None = None, days: int = 7, group_by: tuple[str, ...] = ("day", "model", "host")) -> list[dict]:
+    """
+    Aggregates the ledger of the last `days` days, one row per group.
+
+    Returns:
+        list[dict]: The group columns plus requests, errors, cache_hits, prompt_tokens,
+            completion_tokens, avg_ms and ttft/duration p50/p95/p99 (ms).
+    """
+    unknown = set(group_by) - set(GROUP_COLUMNS)
+    if unknown or not group_by:
+        raise ValueError(f"can only group by {', '.join(GROUP_COLUMNS)}")
+    path = path or default_ledger_path()
+    if not os.path.exists(path):
+        return []
+    since = time.strftime("%Y-%m-%d", time.localtime(time.time() - (days - 1) * 86400))
+    columns = ", ".join(group_by)
+    conn = connect(path)
+    try:
+        totals = conn.execute(
+            f"SELECT {columns}, SUM(requests), SUM(errors), SUM(cache_hits), SUM(prompt_tokens), "
+            f"SUM(completion_tokens), SUM(duration_ms) FROM daily WHERE day >= ? "
+            f"GROUP BY {columns} ORDER BY {columns}", (since,)).fetchall()
+        histograms: dict[tuple, dict[str, list]] = {}
+        for *group, metric, bucket, count in conn.execute(
+                f"SELECT {columns}, metric, bucket, SUM(count) FROM latency WHERE day >= ? "
+                f"GROUP BY {columns}, metric, bucket ORDER BY {columns}, metric, bucket", (since,)):
+            histograms.setdefault(tuple(group), {}).setdefault(metric, []).append((bucket, count))
+    finally:
+        conn.close()
+
+    report = []
+    n = len(group_by)
+    for row in totals:
+        group = tuple(row[:n])
+        requests, errors, cache_hits, prompt_tokens, completion_tokens, duration_ms = row[n:]
+        entry = dict(zip(group_by, group))
+        entry.update(requests=requests, errors=errors, cache_hits=cache_hits, prompt_tokens=prompt_tokens,
+                     completion_tokens=completion_tokens, avg_ms=duration_ms / requests if requests else 0.0)
+        metrics = histograms.get(group, {})
+        for metric in ("ttft", "duration"):
+            p50, p95, p99 = _percentiles(metrics.get(metric, []), (0.50, 0.95, 0.99))
+            entry.update({f"{metric}_p50": p50, f"{metric}_p95": p95, f"{metric}_p99": p99})
+        report.append(entry)
+    return report
+
+
+def print_usage_report(report: list[dict], group_by: tuple[str, ...] = ("day", "model", "host")) -> None:
+    """Prints usage_report() rows as a table."""
+    if not report:
+        print("No usage recorded yet.")
+        return
+
+    def ms(value):
+        return f"{value:.0f}" if value is not None else "-"
+
+    headers = [*(g.capitalize() for g in group_by), "Requests", "Errors", "Cached", "Prompt tok", "Output tok",
+               "TTFT p50", "TTFT p95", "TTFT p99", "Total p50", "Total p95", "Total p99"]
+    rows = [[*(str(r[g]) for g in group_by), str(r["requests"]), str(r["errors"]), str(r["cache_hits"]),
+             str(r["prompt_tokens"]), str(r["completion_tokens"]),
+             ms(r["ttft_p50"]), ms(r["ttft_p95"]), ms(r["ttft_p99"]),
+             ms(r["duration_p50"]), ms(r["duration_p95"]), ms(r["duration_p99"])] for r in report]
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+
+    def fmt(cells):
+        return "  ".join(c.ljust(w) if i < len(group_by) else c.rjust(w)
+                         for i, (c, w) in enumerate(zip(cells, widths)))
+
+    print(fmt(headers))
+    print("  ".join("-" * w for w in widths))
+    for row in rows:
+        print(fmt(row))
+    print("(latencies in ms)")
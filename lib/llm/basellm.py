@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+from lib.llm.tokens import get_estimator, context_length_for, DEFAULT_COMPLETION_RESERVE, MESSAGE_OVERHEAD_TOKENS
+
 class BaseApiLLM(ABC):
 
     def __init__(self, base_url : str, model_name: str):
@@ -7,7 +9,8 @@ class BaseApiLLM(ABC):
         self.base_url = base_url
         # params dictionary
         self.params = {
-            "system_prompt": "respond to the question the best you can"
+            "system_prompt": "respond to the question the best you can",
+            "context_length": context_length_for(model_name)
         }
         print(f"Initializing API LLM: {self.model_name} to {self.base_url}")
 
@@ -21,20 +24,60 @@ class BaseApiLLM(ABC):
         print("Current Model ->",self.model_name)
 
     @abstractmethod
-    def generate_text(self, prompt: str, stream: bool = False, max_tokens: int = 50) -> dict:
+    def generate_text(self, prompt: str, stream: bool = False, max_tokens: int | None = None,
+                      on_token=None, deadline=None, history: list[dict] | None = None,
+                      json_schema: dict | None = None) -> dict:
         """
         Generates text based on the provided prompt.
+        history holds earlier turns of the conversation as {"role", "content"} messages;
+        a leading "system" message replaces params["system_prompt"].
+        If max_tokens is set, the server stops generating after that many tokens.
+        When streaming, each text piece is passed to on_token(piece) if given, otherwise printed.
+        If a Deadline is given, or on Ctrl-C, the stream is closed and the partial answer returned.
+        on_token may also raise StopStream to end the answer early the same way.
+        If json_schema is given the answer is constrained to JSON matching it.
 
         Returns:
             dict: {
                 "text": str,
                 "prompt_tokens": int,
                 "completion_tokens": int,
-                "total_tokens": int
+                "total_tokens": int,
+                "stopped": None | "timeout" | "cancelled" | "early",
+                "ttft": float | None,  # seconds from the request to the first token
+                "error": str | None  # class of the failure if the request failed, e.g. "ConnectionError"
             }
         """
         raise NotImplementedError
 
+    def chat_with_tools(self, messages: list[dict], tools: list[dict], max_tokens: int | None = None,
+                        deadline=None) -> dict | None:
+        """
+        Sends a full chat (no streaming) with tool definitions the model may call.
+
+        Args:
+            messages (list[dict]): The conversation, including earlier assistant and tool messages.
+            tools (list[dict]): Tool definitions in the OpenAI function-calling schema.
+
+        Returns:
+            dict | None: {
+                "text": str,
+                "tool_calls": [{"id": str, "name": str, "arguments": dict}],
+                "message": dict,  # the assistant message to append to `messages`, in this backend's format
+                "prompt_tokens", "completion_tokens", "total_tokens": int
+            }
+            or None if the request failed.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support tool calls")
+
+    def supports_tools(self) -> bool:
+        """Whether this backend implements chat_with_tools."""
+        return type(self).chat_with_tools is not BaseApiLLM.chat_with_tools
+
+    def tool_result_message(self, call: dict, output: str) -> dict:
+        """Message that returns the output of a tool call to the model."""
+        return {"role": "tool", "tool_call_id": call["id"], "content": output}
+
     # @abstractmethod
     def set_params(self, new_params: dict) -> None:
         """Sets parameters for the LLM like top_p probability and temperature."""
@@ -46,3 +89,70 @@ class BaseApiLLM(ABC):
                 # print(f"[BaseApiLLM] Updating the key '{k}' to '{v}' in params.")
             else :
                 print(f"[BaseApiLLM] ERROR Updating the key '{k}' to '{v}' in params, the key '{k}' not exist")
+
+    def count_tokens(self, text: str) -> int:
+        """Estimates locally how many tokens `text` is for this model."""
+        return get_estimator(self.model_name).count(text)
+
+    def count_message_tokens(self, messages: list[dict]) -> int:
+        """Estimates the tokens taken by chat messages, including template overhead."""
+        estimator = get_estimator(self.model_name)
+        return sum(estimator.count(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+    def fit_prompt(self, prompt: str, max_tokens: int | None = None, overflow: str = "truncate",
+                   history: list[dict] | None = None) -> str | None:
+        """
+        Checks the prompt against the model context length before sending it.
+
+        Args:
+            prompt (str): The user prompt.
+            max_tokens (int | None): Tokens reserved for the answer (DEFAULT_COMPLETION_RESERVE if None).
+            overflow (str): "truncate" to keep the end of the prompt that fits, "reject" to refuse it.
+            history (list[dict] | None): Earlier messages sent along with the prompt.
+
+        Returns:
+            str | None: The prompt to send, or None if it was rejected.
+        """
+        estimator = get_estimator(self.model_name)
+        context_length = self.params["context_length"]
+        reserve = max_tokens if max_tokens else DEFAULT_COMPLETION_RESERVE
+        system_tokens = estimator.count(self.params["system_prompt"]) + 2 * MESSAGE_OVERHEAD_TOKENS
+        budget = context_length - reserve - system_tokens
+        if history:
+            budget -= self.count_message_tokens(history)
+
+        prompt_tokens = estimator.count(prompt)
+        if prompt_tokens <= budget:
+            return prompt
+
+        approx = "" if estimator.exact else "~"
+        if overflow == "reject" or budget <= 0:
+            print(f"Error: prompt is {approx}{prompt_tokens} tokens, only {max(budget, 0)} fit in the "
+                  f"{context_length} token context of {self.model_name} (with {reserve} reserved for the answer).")
+            return None
+
+        print(f"Warning: prompt truncated from {approx}{prompt_tokens} to {budget} tokens "
+              f"to fit the {context_length} token context of {self.model_name}.")
+        return estimator.truncate(prompt, budget)
+
+    def calibrate_tokens(self, prompt: str, response_data: dict) -> None:
+        """Feeds the prompt token count reported by the server back to the local estimator."""
+        actual = response_data.get("prompt_tokens", 0)
+        if actual:
+            text = f"{self.params['system_prompt']}\n{prompt}"
+            get_estimator(self.model_name).calibrate(text, actual)
+
+    def estimate_missing_usage(self, prompt: str, response_data: dict) -> dict:
+        """
+        Fills in local token estimates when a stopped stream never got the server usage report.
+        """
+        if response_data.get("stopped") and not response_data.get("total_tokens"):
+            prompt_tokens = self.count_tokens(f"{self.params['system_prompt']}\n{prompt}")
+            completion_tokens = self.count_tokens(response_data.get("text", ""))
+            response_data.update({
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "estimated": True
+            })
+        return response_data
@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+class Deadline:
+    """
+    Time budgets for one request, measured from when the Deadline is created.
+
+    - connect: seconds to establish the connection to the server
+    - first_token: seconds until the first token arrives (covers model load and prefill)
+    - total: seconds until the whole answer must be complete
+
+    Any budget can be None (unlimited).
+    """
+
+    def __init__(self, connect: float | None = None, first_token: float | None = None,
+                 total: float | None = None):
+        self.connect = connect
+        self.first_token = first_token
+        self.total = total
+        self.start = time.monotonic()
+
+    @classmethod
+    def parse(cls, spec: str) -> "Deadline":
+        """
+        Builds a Deadline from a --timeout value.
+
+        Args:
+            spec (str): Either a number of seconds for the total budget ("120"), or
+                comma separated budgets ("connect=5,first=30,total=120").
+
+        Raises:
+            ValueError: If the spec can't be parsed or a budget isn't a positive number.
+        """
+        names = {"connect": "connect", "first": "first_token", "first_token": "first_token", "total": "total"}
+        budgets = {}
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            key, sep, value = part.partition("=")
+            if not sep:
+                key, value = "total", key
+            if key not in names:
+                raise ValueError(f"unknown timeout budget '{key}' (expected connect, first or total)")
+            seconds = float(value)
+            if not seconds > 0:
+                raise ValueError(f"timeout budget '{key}' must be a positive number of seconds")
+            budgets[names[key]] = seconds
+        return cls(**budgets)
+
+    def remaining(self) -> float | None:
+        """Seconds left of the total budget, or None if there is no total budget."""
+        if self.total is None:
+            return None
+        return max(0.0, self.total - (time.monotonic() - self.start))
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def connect_timeout(self) -> float | None:
+        return _min(self.connect, self.remaining())
+
+    def first_token_timeout(self) -> float | None:
+        """Seconds left to receive the first token (bounded by the total budget)."""
+        first = None
+        if self.first_token is not None:
+            first = max(0.0, self.first_token - (time.monotonic() - self.start))
+        return _min(first, self.remaining())
+
+    def requests_timeout(self):
+        """(connect, read) timeout tuple for `requests`, covering the wait for the first token."""
+        return (self.connect_timeout(), self.first_token_timeout())
+
+    def watch(self, close) -> "Watchdog":
+        """Returns a Watchdog that calls close() when the first-token or total budget runs out."""
+        return Watchdog(self, close)
+
+
+class Watchdog:
+    """
+    Closes a response stream from a timer thread when its deadline expires.
+
+    Closing the connection is what makes the server stop generating; the
+    reading thread then gets an error from the closed stream, and checks
+    `fired` to tell a deadline apart from a real failure.
+
+    Usage:
+        with deadline.watch(response.close) as watchdog:
+            for chunk in stream:
+                watchdog.got_token()
+    """
+
+    def __init__(self, deadline: Deadline, close):
+        self.deadline = deadline
+        self.close = close
+        self.fired: str | None = None  # "first_token" or "total" once expired
+        self.timer: threading.Timer | None = None
+        self.seen_token = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        # Both budgets count from the same start, so the smaller one is the one that expires first
+        first, total = self.deadline.first_token, self.deadline.total
+        budget = "first_token" if first is not None and (total is None or first < total) else "total"
+        self._arm(self.deadline.first_token_timeout(), budget)
+        return self
+
+    def __exit__(self, *exc):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+        return False
+
+    def got_token(self) -> None:
+        """Switches from the first-token budget to the total budget on the first token."""
+        if self.seen_token:
+            return
+        self.seen_token = True
+        self._arm(self.deadline.remaining(), "total")
+
+    def _arm(self, seconds: float | None, budget: str) -> None:
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            if seconds is None:
+                return
+            self.timer = threading.Timer(seconds, self._expire, args=(budget,))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _expire(self, budget: str) -> None:
+        self.fired = budget
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def _min(a: float | None, b: float | None) -> float | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
@@ -1,10 +1,16 @@
 
 import json
+import time
+from contextlib import nullcontext
 import requests
+from requests.adapters import HTTPAdapter
 
 from lib.llm.basellm import BaseApiLLM
+from lib.llm.deadline import Deadline
+from lib.llm.stream import StreamDecoder, StopStream, STREAM_CHUNK_SIZE, ollama_usage
 # from lib.utils.text import clear_markdown_to_color # Removed as it's no longer in utils and functionality is not immediately required
 from lib.llm.prompts import explain_terminal
+from lib.utils.trace import tracer, span, trace_dns
 
 config = {
     "ollama_url":"http://10.1.1.62:11434/api/generate",
@@ -12,6 +18,8 @@ config = {
 }
 OLLAMA_URL = config["ollama_url"]
 MODEL_NAME = config["model"]
+OLLAMA_DEFAULT_NUM_CTX = 4096
+OLLAMA_POOL_SIZE = 16 # Keep-alive connections kept per OllamaApi, i.e. max concurrent requests without reconnecting
 
 def create_payload_query(prompt):
     ollama_prompt_explanation = """
@@ -25,6 +33,13 @@ def create_payload_query(prompt):
     }
 
 
+def iter_pieces(response):
+    """Yields the text pieces of a streamed Ollama response."""
+    for piece, _ in StreamDecoder(response.iter_content(STREAM_CHUNK_SIZE)):
+        if piece:
+            yield piece
+
+
 def hello():
     print("hello from ollama 3")
     hello_text()
@@ -44,17 +59,10 @@ def query_ollama_stream(base_url : str, prompt):
         # Variable to hold concatenated response strings if no callback is provided
         full_response = ""
 
-        # Iterating over the response line by line and displaying the details
-        for line in response.iter_lines():
-            if line:
-                # Parsing each line (JSON chunk) and extracting the details
-                chunk = json.loads(line)
-
-                # If this is not the last chunk, add the "response" field value to full_response and print it
-                if not chunk.get("done"):
-                    response_piece = chunk.get("response", "")
-                    full_response += response_piece
-                    print(response_piece, end="", flush=True)
+        # Iterating over the text pieces and displaying them
+        for response_piece in iter_pieces(response):
+            full_response += response_piece
+            print(response_piece, end="", flush=True)
 
         if response == "":
             print("Error parsing response")
@@ -71,14 +79,9 @@ def query_ollama(base_url : str, prompt):
         with requests.post(base_url, json=payload, stream=True) as response:
             response.raise_for_status()
  
-            for line in response.iter_lines():
-                if line:
-                    chunk = json.loads(line)
-                    # Check if the chunk has a done flag
-                    if not chunk.get("done"):
-                        response_piece = chunk.get("response", "")
-                        response_text += response_piece
-                        # print(response_piece, end="", flush=True)
+            for response_piece in iter_pieces(response):
+                response_text += response_piece
+                # print(response_piece, end="", flush=True)
 
             print()  # To ensure new line after printing the command
 
@@ -110,17 +113,10 @@ def query_stream(model_name: str, base_url : str, prompt):
         # Variable to hold concatenated response strings if no callback is provided
         full_response = ""
 
-        # Iterating over the response line by line and displaying the details
-        for line in response.iter_lines():
-            if line:
-                # Parsing each line (JSON chunk) and extracting the details
-                chunk = json.loads(line)
-
-                # If this is not the last chunk, add the "response" field value to full_response and print it
-                if not chunk.get("done"):
-                    response_piece = chunk.get("response", "")
-                    full_response += response_piece
-                    print(response_piece, end="", flush=True)
+        # Iterating over the text pieces and displaying them
+        for response_piece in iter_pieces(response):
+            full_response += response_piece
+            print(response_piece, end="", flush=True)
 
         if response == "":
             print("Error parsing response")
@@ -130,86 +126,125 @@ def query_stream(model_name: str, base_url : str, prompt):
 
 # Final methods ######################################################################################
 
-def generate_text(base_url : str, payload:dict, stream: bool = True ) -> dict:
+def generate_text(base_url : str, payload:dict, stream: bool = True, on_token=None, deadline: Deadline = None,
+                  session: requests.Session = None) -> dict:
+    """
+    Sends a payload to the Ollama generate (or chat) endpoint and collects the answer.
+
+    Args:
+        base_url (str): Full URL of the endpoint, e.g. "http://localhost:11434/api/generate".
+        payload (dict): The request body.
+        stream (bool): Print (or pass to on_token) the answer while it is generated.
+        on_token (callable, optional): Called with each text piece instead of printing it.
+        deadline (Deadline, optional): Connect / first token / total time budgets.
+        session (requests.Session, optional): Session whose pooled connections are reused.
+
+    Returns:
+        dict: {"text", "prompt_tokens", "completion_tokens", "total_tokens", "stopped", "ttft", "error"}
+        "ttft" is the seconds from sending the request to the first token (None without one).
+        "error" is the class of the failure (e.g. "ConnectionError", "HTTPError") if the request failed.
+        "stopped" is "timeout", "cancelled" (Ctrl-C) or "early" (on_token raised StopStream)
+        when the answer was cut short, else None.
+        On a stop the stream is closed, which makes Ollama abort the generation.
+    """
     prompt_tokens = 0
     completion_tokens = 0
     total_tokens = 0
-
-    if stream:
-        full_response = ""
-        final_chunk_data = {}
-        try:
-            with requests.post(base_url, json=payload, stream=True) as response:
-                response.raise_for_status()
-                print() # Start stream on new line
-                for line in response.iter_lines():
-                    if line:
-                        chunk = json.loads(line)
-                        if not chunk.get("done"):
-                            response_piece = chunk.get("response", "")
-                            full_response += response_piece
-                            print(response_piece, end="", flush=True)
-                        else:
+    stopped = None
+    error = None
+
+    if stream and on_token is None:
+        on_token = lambda piece: print(piece, end="", flush=True)
+        print() # Start stream on new line
+        printing = True
+    else:
+        printing = False
+
+    # Phase timings for --trace: request (connect + headers), first token (prefill), stream
+    trace_dns(base_url)
+    request_start = first_token_at = None
+
+    full_response = ""
+    final_chunk_data = {}
+    watchdog = None
+    mode = "stream" if stream else "non-stream"
+    try:
+        # Ollama sends line-by-line JSON objects ending with a "done" one, so we always read
+        # the response as a stream, and only print pieces when streaming was requested.
+        request_start = time.perf_counter()
+        timeout = deadline.requests_timeout() if deadline else None
+        with (session or requests).post(base_url, json=payload, stream=True, timeout=timeout) as response:
+            headers_at = time.perf_counter()
+            tracer.add_span("ollama.request", request_start, headers_at, url=base_url)
+            response.raise_for_status()
+            decoder = StreamDecoder(response.iter_content(STREAM_CHUNK_SIZE), timed=tracer.enabled)
+            with (deadline.watch(response.close) if deadline else nullcontext()) as watchdog:
+                for response_piece, chunk in decoder:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        tracer.add_span("ollama.first_token", headers_at, first_token_at)
+                        if watchdog:
+                            watchdog.got_token()
+                    if response_piece:
+                        full_response += response_piece
+                        if stream:
+                            on_token(response_piece)
+                    if chunk is not None:
+                        if chunk.get("error"):
+                            print(f"Error from Ollama: {chunk['error']}")
+                            error = "ollama_error"
+                        if chunk.get("done"):
                             # This is the final chunk with metadata
                             final_chunk_data = chunk
-                            print() # Newline after stream completion
-
-                if final_chunk_data:
-                    prompt_tokens = final_chunk_data.get("prompt_eval_count", 0)
-                    completion_tokens = final_chunk_data.get("eval_count", 0)
-                    total_tokens = prompt_tokens + completion_tokens
 
-        except requests.RequestException as e:
-            print(f"Error fetching data from Ollama (stream): {str(e)}")
-            # Return empty/error structure or raise? For now, return what we have.
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from Ollama (stream): {str(e)}")
-
-        return {
-            "text": full_response, # Raw text for stream
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens
-        }
-    else: # Non-streaming
-        response_text = ""
-        final_chunk_data = {}
-        try:
-            # For non-streaming, Ollama typically sends a single JSON object response
-            # if stream=False is respected by the server.
-            # However, the previous code iterated lines, suggesting it might still be chunked
-            # or that stream=False in payload might not prevent line-by-line response.
-            # Assuming the server might still send line-by-line JSON objects ending with a "done" one.
-            with requests.post(base_url, json=payload, stream=True) as response: # Keep stream=True for iter_lines
-                response.raise_for_status()
-                for line in response.iter_lines():
-                    if line:
-                        chunk = json.loads(line)
-                        if not chunk.get("done"):
-                            response_text += chunk.get("response", "")
-                        else:
-                            final_chunk_data = chunk # This is the final summary chunk
-
-                if final_chunk_data:
-                    prompt_tokens = final_chunk_data.get("prompt_eval_count", 0)
-                    completion_tokens = final_chunk_data.get("eval_count", 0)
-                    total_tokens = prompt_tokens + completion_tokens
-                else: # Fallback if 'done' message wasn't received or parsed
-                    print("Warning: Final 'done' chunk not processed in non-streaming mode for Ollama.")
-
-
-        except requests.RequestException as e:
-            print(f"Error fetching data from Ollama (non-stream): {str(e)}")
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON from Ollama (non-stream): {str(e)}")
+            tracer.add_span("ollama.stream", first_token_at or headers_at, time.perf_counter(),
+                            chunks=decoder.frames, json_decode_ms=decoder.decode_seconds * 1000)
+
+            if final_chunk_data:
+                prompt_tokens, completion_tokens = ollama_usage(final_chunk_data)
+                total_tokens = prompt_tokens + completion_tokens
+            elif not stream: # Fallback if 'done' message wasn't received or parsed
+                print("Warning: Final 'done' chunk not processed in non-streaming mode for Ollama.")
+
+    except KeyboardInterrupt:
+        stopped = "cancelled"
+    except StopStream:
+        stopped = "early"
+    except requests.Timeout as e:
+        stopped = "timeout"
+        print(f"\nTimed out waiting for Ollama: {str(e)}")
+    except requests.RequestException as e:
+        if watchdog and watchdog.fired:
+            stopped = "timeout"
+        else:
+            print(f"Error fetching data from Ollama ({mode}): {str(e)}")
+            error = type(e).__name__
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON from Ollama ({mode}): {str(e)}")
+        error = type(e).__name__
+    except Exception:
+        # Reading from a stream the watchdog closed fails with assorted errors
+        if not (watchdog and watchdog.fired):
+            raise
+        stopped = "timeout"
+
+    if printing:
+        print() # Newline after stream completion
+    if stopped == "timeout" and watchdog and watchdog.fired:
+        budget = "first token" if watchdog.fired == "first_token" else "total"
+        print(f"Timed out ({budget} deadline), generation aborted.")
+    elif stopped == "cancelled":
+        print("Cancelled, generation aborted.")
 
-        # Apply color only for non-streamed, fully collected text
-        return {
-            "text": response_text if response_text else "", # Removed clear_markdown_to_color
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens
-        }
+    return {
+        "text": full_response, # Raw text, color is left to the caller
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        "stopped": stopped,
+        "ttft": first_token_at - request_start if first_token_at else None,
+        "error": error
+    }
 
 def list_models(base_url):
     """
@@ -235,17 +270,100 @@ def list_models(base_url):
 
 # Example usage (you would need to create a concrete subclass of this)
 class OllamaApi(BaseApiLLM):
-    def generate_text(self, prompt: str, stream: bool = False,  max_tokens: int = 50) -> dict: # Ensure stream default matches base
+    def __init__(self, base_url : str, model_name: str):
+        super().__init__(base_url, model_name)
+        # Ollama only allocates `num_ctx` tokens of context (not the model maximum),
+        # so we cap it to the server default and always send it explicitly.
+        self.params["context_length"] = min(self.params["context_length"], OLLAMA_DEFAULT_NUM_CTX)
+        # Reuse connections between requests instead of reconnecting every time
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE))
+
+    def generate_text(self, prompt: str, stream: bool = False,  max_tokens: int | None = None,
+                      on_token=None, deadline: Deadline = None, history: list[dict] = None,
+                      json_schema: dict | None = None) -> dict: # Ensure stream default matches base
+
+        options = {"num_ctx": self.params["context_length"]}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+
+        system_prompt = self.params["system_prompt"]
+        if history and history[0]["role"] == "system": # Caller provided its own system prompt
+            system_prompt = history[0]["content"]
+            history = history[1:]
+
+        if history:
+            # Earlier turns go through the chat endpoint; Ollama reuses the KV cache
+            # for the unchanged message prefix, so only the new turn is prefilled.
+            endpoint = "/api/chat"
+            payload = {
+                "model": self.model_name,
+                "messages": [{"role": "system", "content": system_prompt},
+                             *history,
+                             {"role": "user", "content": prompt}],
+                "options": options
+            }
+        else:
+            endpoint = "/api/generate"
+            payload = {
+                "model": self.model_name,
+                "prompt": f"{prompt}", # The prompt passed to agent.generate_response already includes file content
+                "system": system_prompt,
+                "options": options
+            }
+
+        if json_schema:
+            payload["format"] = json_schema
 
-        payload = {
-            "model": self.model_name,
-            "prompt": f"{prompt}", # The prompt passed to agent.generate_response already includes file content
-            "system": self.params["system_prompt"]
-            # "max_tokens": max_tokens # Ollama generate API might use "options": {"num_predict": max_tokens}
+        # The helper `generate_text` now returns the dictionary directly.
+        result = generate_text(f"{self.base_url}{endpoint}", payload, stream, on_token=on_token, deadline=deadline,
+                               session=self.session)
+        return self.estimate_missing_usage(prompt, result)
+
+    def chat_with_tools(self, messages: list[dict], tools: list[dict], max_tokens: int | None = None,
+                        deadline: Deadline = None) -> dict | None:
+        options = {"num_ctx": self.params["context_length"]}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        payload = {"model": self.model_name, "messages": messages, "tools": tools, "stream": False,
+                   "options": options}
+        try:
+            with span("ollama.chat_with_tools", model=self.model_name):
+                response = self.session.post(f"{self.base_url}/api/chat", json=payload,
+                                             timeout=deadline.requests_timeout() if deadline else None)
+                response.raise_for_status()
+                data = response.json()
+        except requests.RequestException as e:
+            print(f"Error fetching data from Ollama (tools): {str(e)}")
+            return None
+
+        message = data.get("message") or {}
+        tool_calls = []
+        for i, call in enumerate(message.get("tool_calls") or []):
+            function = call.get("function") or {}
+            arguments = function.get("arguments") or {}
+            if isinstance(arguments, str): # Some models return the arguments JSON encoded
+                try:
+                    arguments = json.loads(arguments)
+                except json.JSONDecodeError:
+                    arguments = {}
+            # Ollama doesn't give calls an id, results are matched by tool name and order
+            tool_calls.append({"id": call.get("id") or f"call_{i}", "name": function.get("name", ""),
+                               "arguments": arguments})
+        prompt_tokens, completion_tokens = ollama_usage(data)
+        return {
+            "text": message.get("content") or "",
+            "tool_calls": tool_calls,
+            "message": {"role": "assistant", "content": message.get("content") or "",
+                        "tool_calls": message.get("tool_calls") or []},
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
         }
 
-        # The helper `generate_text` now returns the dictionary directly.
-        return generate_text(f"{self.base_url}/api/generate", payload, stream)
+    def tool_result_message(self, call: dict, output: str) -> dict:
+        return {"role": "tool", "tool_name": call["name"], "content": output}
 
     def set_params(self, new_params: dict) -> None:
         # for k, v in new_params.items():
@@ -12,119 +12,205 @@ class OpenAiApi(BaseApiLLM):
 
 
 
-from openai import OpenAI, APIConnectionError # Import APIConnectionError
+import json
+import time
+from contextlib import nullcontext
+
+from openai import OpenAI, APIConnectionError, APITimeoutError, Timeout # Import APIConnectionError
 
 from lib.llm.basellm import BaseApiLLM
+from lib.llm.deadline import Deadline
+from lib.llm.stream import StreamDecoder, StopStream, OPENAI_TEXT_KEYS, openai_usage
+from lib.utils.trace import tracer, span, trace_dns
 
 class OpenAiApi(BaseApiLLM):
 
     def __init__(self, base_url : str, model_name: str):
         super().__init__(base_url, model_name)
-        self.client = OpenAI(base_url=f"{self.base_url}/engines/v1", api_key="docker")
+        with span("openai.client_init"):
+            self.client = OpenAI(base_url=f"{self.base_url}/engines/v1", api_key="docker")
         print("OpenAI API -> ",self.base_url)
 
 
 
-    def generate_text(self, prompt: str, stream: bool = False,  max_tokens: int = 50) -> dict:
-        default_error_response = {
-            "text": "", "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0
-        }
-        try:
-
-            prompt_tokens = 0
-            completion_tokens = 0
-            total_tokens = 0
+    def generate_text(self, prompt: str, stream: bool = False,  max_tokens: int | None = None,
+                      on_token=None, deadline: Deadline = None, history: list[dict] = None,
+                      json_schema: dict | None = None) -> dict:
+        prompt_tokens = 0
+        completion_tokens = 0
+        total_tokens = 0
+        full_response_text = ""
+        stopped = None
+        error = None
+        watchdog = None
+        request_start = first_token_at = None
+
+        limits = {"max_tokens": max_tokens} if max_tokens else {}
+        if deadline:
+            # Before the first token arrives only the first-token budget matters; a non-streamed
+            # answer arrives all at once, so it gets the whole remaining budget.
+            read_timeout = deadline.first_token_timeout() if stream else deadline.remaining()
+            limits["timeout"] = Timeout(read_timeout, connect=deadline.connect_timeout())
+        # The SDK retries failed requests by default, each retry with a fresh timeout,
+        # which would let a deadline run over several times
+        client = self.client.with_options(max_retries=0) if deadline else self.client
+        if json_schema:
+            # Strict mode is rejected unless the schema closes its objects with additionalProperties: false
+            strict = json_schema.get("additionalProperties") is False
+            limits["response_format"] = {"type": "json_schema",
+                                         "json_schema": {"name": "answer", "schema": json_schema, "strict": strict}}
+
+        history = history or []
+        if not (history and history[0]["role"] == "system"): # Unless the caller provided its own system prompt
+            history = [{"role": "system", "content": self.params["system_prompt"]}, *history]
+        messages = [*history, {"role": "user", "content": prompt}]
 
+        try:
+            trace_dns(self.base_url)
+            request_start = time.perf_counter()
             if stream:
-                completion = self.client.chat.completions.create(
+                # Read the raw SSE stream and decode it with StreamDecoder instead of
+                # building one SDK object per chunk
+                with client.chat.completions.with_streaming_response.create(
                     model=f"{self.model_name}",
-                    messages=[
-                        {"role": "system", "content": self.params["system_prompt"]},
-                        {"role": "user", "content": prompt},
-                    ],
+                    messages=messages,
                     stream=True,
-                    stream_options={"include_usage": True} # <--- IMPORTANT: Request usage info
-                    # max_tokens=max_tokens
-                )
-
-                full_response_text = ""
-                print()
-                for chunk in completion:
-                    data = chunk.choices[0].delta.content
-                    if data is not None:
-                        full_response_text += data
-                        print(data, end="", flush=True)
-                
-
-                    elif chunk.usage:
-                        # This is the final chunk containing usage information
-                        usage = chunk.usage
-                        prompt_tokens = usage.prompt_tokens
-                        completion_tokens = usage.completion_tokens
-                        total_tokens = usage.total_tokens
-                     
-                print()
-
-                return {
-                    "text": full_response_text,
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": total_tokens
-                }
+                    stream_options={"include_usage": True}, # <--- IMPORTANT: Request usage info
+                    **limits
+                ) as completion:
+                    headers_at = time.perf_counter()
+                    tracer.add_span("openai.request", request_start, headers_at, url=self.base_url)
+                    decoder = StreamDecoder(completion.iter_bytes(), sse=True, text_keys=OPENAI_TEXT_KEYS,
+                                            timed=tracer.enabled)
+
+                    if on_token is None:
+                        print()
+                    try:
+                        # Closing the stream (on deadline, or when leaving the `with` on Ctrl-C)
+                        # drops the connection so the server stops generating
+                        with (deadline.watch(completion.close) if deadline else nullcontext()) as watchdog:
+                            for data, chunk in decoder:
+                                if first_token_at is None:
+                                    first_token_at = time.perf_counter()
+                                    tracer.add_span("openai.first_token", headers_at, first_token_at)
+                                    if watchdog:
+                                        watchdog.got_token()
+                                if data:
+                                    full_response_text += data
+                                    if on_token is not None:
+                                        on_token(data)
+                                    else:
+                                        print(data, end="", flush=True)
+
+                                if chunk is not None:
+                                    if chunk.get("error"):
+                                        print(f"Error from OpenAI API: {chunk['error']}")
+                                        error = "openai_error"
+                                    usage = openai_usage(chunk)
+                                    if usage:
+                                        # This is the final chunk containing usage information
+                                        prompt_tokens, completion_tokens = usage
+                                        total_tokens = prompt_tokens + completion_tokens
+                    finally:
+                        if on_token is None:
+                            print()
+                tracer.add_span("openai.stream", first_token_at or headers_at, time.perf_counter(),
+                                chunks=decoder.frames, json_decode_ms=decoder.decode_seconds * 1000)
             else:
-                completion = self.client.chat.completions.create(
+                completion = client.chat.completions.create(
                     model=f"{self.model_name}",
-                    messages=[
-                        {"role": "system", "content": self.params["system_prompt"]},
-                        {"role": "user", "content": prompt},
-                    ],
-                    # max_tokens=max_tokens
+                    messages=messages,
+                    **limits
                 )
-
-                text_response = ""
+                first_token_at = time.perf_counter() # The whole answer arrives at once
+                tracer.add_span("openai.request", request_start, first_token_at, url=self.base_url)
 
                 if completion.choices and completion.choices[0].message:
-                    text_response = completion.choices[0].message.content
+                    full_response_text = completion.choices[0].message.content or ""
 
                 if hasattr(completion, 'usage') and completion.usage:
                     prompt_tokens = completion.usage.prompt_tokens if completion.usage.prompt_tokens is not None else 0
                     completion_tokens = completion.usage.completion_tokens if completion.usage.completion_tokens is not None else 0
                     total_tokens = completion.usage.total_tokens if completion.usage.total_tokens is not None else 0
-                    
-
-                return {
-                    "text": text_response,
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": total_tokens
-                }
-        except APIConnectionError as e:
-            print(f"Error connecting to OpenAI API: {e}")
-            return default_error_response
-        except Exception as e: # Catch any other unexpected errors during API call
-            print(f"An unexpected error occurred with OpenAI API: {e}")
-            return default_error_response
-            prompt_tokens = 0
-            completion_tokens = 0
-            total_tokens = 0
-
-            if completion.choices and completion.choices[0].message:
-                text_response = completion.choices[0].message.content
-
-            if hasattr(completion, 'usage') and completion.usage:
-                prompt_tokens = completion.usage.prompt_tokens if completion.usage.prompt_tokens is not None else 0
-                completion_tokens = completion.usage.completion_tokens if completion.usage.completion_tokens is not None else 0
-                total_tokens = completion.usage.total_tokens if completion.usage.total_tokens is not None else 0
-
-            # print(completion) # Optional: for debugging the raw completion object
-            return {
-                "text": text_response,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": total_tokens
-            }
-
 
+        except KeyboardInterrupt:
+            stopped = "cancelled"
+            print("Cancelled, generation aborted.")
+        except StopStream:
+            stopped = "early"
+        except Exception as e: # Catch any other unexpected errors during API call
+            if watchdog and watchdog.fired:
+                # Reading from the stream the watchdog closed fails with a connection (or other) error
+                stopped = "timeout"
+                budget = "first token" if watchdog.fired == "first_token" else "total"
+                print(f"Timed out ({budget} deadline), generation aborted.")
+            elif isinstance(e, APITimeoutError):
+                stopped = "timeout"
+                print(f"Timed out waiting for OpenAI API: {e}")
+            elif isinstance(e, APIConnectionError):
+                print(f"Error connecting to OpenAI API: {e}")
+                error = type(e).__name__
+            else:
+                print(f"An unexpected error occurred with OpenAI API: {e}")
+                error = type(e).__name__
+
+        return self.estimate_missing_usage(prompt, {
+            "text": full_response_text,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "stopped": stopped,
+            "ttft": first_token_at - request_start if first_token_at else None,
+            "error": error
+        })
+
+
+
+    def chat_with_tools(self, messages: list[dict], tools: list[dict], max_tokens: int | None = None,
+                        deadline: Deadline = None) -> dict | None:
+        limits = {"max_tokens": max_tokens} if max_tokens else {}
+        if deadline:
+            limits["timeout"] = Timeout(deadline.remaining(), connect=deadline.connect_timeout())
+        client = self.client.with_options(max_retries=0) if deadline else self.client
+        try:
+            with span("openai.chat_with_tools", model=self.model_name):
+                completion = client.chat.completions.create(
+                    model=f"{self.model_name}",
+                    messages=messages,
+                    tools=tools,
+                    **limits
+                )
+        except Exception as e:
+            print(f"An unexpected error occurred with OpenAI API (tools): {e}")
+            return None
+
+        message = completion.choices[0].message if completion.choices else None
+        text = (message.content if message else None) or ""
+        tool_calls = []
+        raw_calls = []
+        for call in (message.tool_calls if message else None) or []:
+            try:
+                arguments = json.loads(call.function.arguments or "{}")
+            except json.JSONDecodeError:
+                arguments = {}
+            tool_calls.append({"id": call.id, "name": call.function.name, "arguments": arguments})
+            raw_calls.append({"id": call.id, "type": "function",
+                              "function": {"name": call.function.name, "arguments": call.function.arguments}})
+        assistant_message = {"role": "assistant", "content": text}
+        if raw_calls:
+            assistant_message["tool_calls"] = raw_calls
+
+        usage = completion.usage
+        prompt_tokens = (usage.prompt_tokens or 0) if usage else 0
+        completion_tokens = (usage.completion_tokens or 0) if usage else 0
+        return {
+            "text": text,
+            "tool_calls": tool_calls,
+            "message": assistant_message,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
 
     def set_params(self, new_params: dict) -> None:
 
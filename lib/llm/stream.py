@@ -0,0 +1,233 @@
+import json
+import time
+from json.decoder import scanstring
+
+# orjson is optional: parses frames straight from a memoryview, and faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bytes asked from the socket per read. With chunked transfer encoding (how both
+# Ollama and OpenAI-compatible servers stream) a read returns as soon as one HTTP
+# chunk is in, so a large size doesn't delay tokens, it only avoids tiny reads.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Keys of the text field in Ollama /api/generate, Ollama /api/chat and OpenAI delta frames.
+# A key followed by `":"` can't occur inside a JSON string value (its quotes would be escaped).
+OLLAMA_TEXT_KEYS = ('"response":"', '"content":"')
+OPENAI_TEXT_KEYS = ('"content":"',)
+
+
+class StopStream(Exception):
+    """
+    Raised from an on_token callback to end a generation early, e.g. once the
+    needed part of the answer has arrived. The backend closes the stream (the
+    server stops generating) and returns the answer so far with stopped="early".
+    """
+
+
+def loads(frame) -> dict:
+    """Parses one JSON frame given as bytes, str or memoryview."""
+    if orjson is not None:
+        return orjson.loads(frame)
+    if isinstance(frame, memoryview):
+        frame = str(frame, "utf-8")
+    return json.loads(frame)
+
+
+def iter_lines(chunks):
+    """
+    Splits a byte stream into lines, yielding memoryviews into the received chunks.
+
+    Lines are sliced out of each chunk without copying; only a line that spans
+    two chunks is joined. Empty lines are skipped.
+    """
+    pending = b""
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+            pending = b""
+        view = memoryview(chunk)
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            line_end = end - 1 if end > start and chunk[end - 1] == 13 else end  # drop "\r" of "\r\n"
+            if line_end > start:
+                yield view[start:line_end]
+            start = end + 1
+        if start < len(chunk):
+            pending = bytes(view[start:])
+    if pending.strip():
+        yield memoryview(pending)
+
+
+class StreamDecoder:
+    """
+    Decodes a streamed LLM response into text pieces and metadata frames.
+
+    Iterating yields (piece, frame) tuples. Plain text frames take a fast path
+    that only extracts the text field with the C string scanner instead of
+    building a dict for every token, and yield (str, None). Any other frame
+    (final usage, errors, tool calls, unusual formatting) is fully parsed and
+    yields (text or None, dict).
+
+    Args:
+        chunks: Iterable of raw response bytes.
+        sse (bool): The stream is Server-Sent Events ("data: {...}" lines, ending
+            with "data: [DONE]") as sent by OpenAI-compatible servers; otherwise NDJSON.
+        text_keys: Keys of the text field to extract (with opening quote).
+        timed (bool): Measure the time spent decoding in `decode_seconds` (for --trace).
+    """
+
+    def __init__(self, chunks, sse: bool = False, text_keys=OLLAMA_TEXT_KEYS, timed: bool = False):
+        self.chunks = chunks
+        self.sse = sse
+        self.text_keys = text_keys
+        self.timed = timed
+        self.frames = 0
+        self.decode_seconds = 0.0
+
+    def __iter__(self):
+        for line in iter_lines(self.chunks):
+            if self.sse:
+                if line[:5] != b"data:":
+                    continue  # comments, "event:" lines, keep-alives
+                line = line[6:] if line[5:6] == b" " else line[5:]
+                if line == b"[DONE]":
+                    return
+            start = time.perf_counter() if self.timed else 0.0
+            piece, frame = self._decode(line)
+            if self.timed:
+                self.decode_seconds += time.perf_counter() - start
+            self.frames += 1
+            yield piece, frame
+
+    def _decode(self, line: memoryview):
+        text = str(line, "utf-8")
+        if not self.sse:
+            fast = '"done":false' in text
+        else:
+            # Usage can arrive together with the last text; parse those frames fully
+            fast = '"usage":{' not in text
+        if fast:
+            for key in self.text_keys:
+                index = text.find(key)
+                if index >= 0:
+                    piece, _ = scanstring(text, index + len(key))
+                    return piece, None
+        frame = loads(text)
+        return (openai_delta_text(frame) if self.sse else ollama_text(frame)), frame
+
+
+def ollama_text(frame: dict) -> str | None:
+    """Text of a fully parsed Ollama frame (/api/generate or /api/chat)."""
+    if frame.get("done"):
+        return None
+    if "message" in frame:
+        return frame["message"].get("content")
+    return frame.get("response")
+
+
+def ollama_usage(frame: dict) -> tuple[int, int]:
+    """(prompt_tokens, completion_tokens) from Ollama's final "done" frame."""
+    return frame.get("prompt_eval_count", 0), frame.get("eval_count", 0)
+
+
+def openai_usage(frame: dict) -> tuple[int, int] | None:
+    """(prompt_tokens, completion_tokens) from an OpenAI chunk with usage, or None."""
+    usage = frame.get("usage")
+    if not usage:
+        return None
+    return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+
+
+def openai_delta_text(frame: dict) -> str | None:
+    """Text of a fully parsed OpenAI chunk."""
+    choices = frame.get("choices") or []
+    if choices:
+        return (choices[0].get("delta") or {}).get("content")
+    return None
+
+
+if __name__ == '__main__':
+    # Microbenchmark: per-token decode cost of the old iter_lines + json.loads loop
+    # versus StreamDecoder, on synthetic Ollama and OpenAI streams.
+    import random
+
+    TOKENS = 20000
+    words = ["the", " command", " ls", " -la", " lists", " all", " files", ",", " including", " hidden",
+             " ones", ".\n", " Use", " `grep", " -r`", " to", " search", " \"quoted\"", " text", " é"]
+    rng = random.Random(1)
+    compact = (",", ":")  # servers send compact JSON
+    ollama_frames = [json.dumps({"model": "devstral:latest", "created_at": "2025-01-01T00:00:00.000000Z",
+                                 "response": rng.choice(words), "done": False}, separators=compact).encode() + b"\n"
+                     for _ in range(TOKENS)]
+    ollama_frames.append(json.dumps({"done": True, "prompt_eval_count": 20, "eval_count": TOKENS}).encode() + b"\n")
+    openai_frames = [b"data: " + json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0,
+                                             "model": "ai/gemma3", "choices": [{"index": 0, "delta": {
+                                                 "content": rng.choice(words)}, "finish_reason": None}]},
+                                            separators=compact).encode()
+                     + b"\n\n" for _ in range(TOKENS)]
+    openai_frames.append(b"data: [DONE]\n\n")
+
+    def baseline_iter_lines(chunks):
+        # What requests.Response.iter_lines does
+        pending = None
+        for chunk in chunks:
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            pending = lines.pop() if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1] else None
+            yield from lines
+        if pending is not None:
+            yield pending
+
+    def baseline_ollama(chunks):
+        text = ""
+        for line in baseline_iter_lines(chunks):
+            if line:
+                chunk = json.loads(line)
+                if not chunk.get("done"):
+                    text += chunk.get("response", "")
+        return text
+
+    def baseline_openai(chunks):
+        text = ""
+        for line in baseline_iter_lines(chunks):
+            if line.startswith(b"data: ") and line != b"data: [DONE]":
+                chunk = json.loads(line[6:])
+                text += chunk["choices"][0]["delta"].get("content") or ""
+        return text
+
+    def decoder_text(chunks, sse):
+        text = ""
+        for piece, _ in StreamDecoder(chunks, sse=sse, text_keys=OPENAI_TEXT_KEYS if sse else OLLAMA_TEXT_KEYS):
+            if piece is not None:
+                text += piece
+        return text
+
+    def rechunk(frames, size):
+        data = b"".join(frames)
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def bench(label, func, chunks):
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            result = func(chunks)
+            best = min(best, time.perf_counter() - start)
+        print(f"  {label:<28} {best / TOKENS * 1e9:8.0f} ns/token")
+        return result
+
+    print(f"JSON parser for full frames: {'orjson' if orjson else 'json'}")
+    for name, frames, sse, baseline in (("ollama ndjson", ollama_frames, False, baseline_ollama),
+                                        ("openai sse", openai_frames, True, baseline_openai)):
+        for layout, chunks in (("1 frame/read", frames), ("512 B reads", rechunk(frames, 512)),
+                               ("64 KiB reads", rechunk(frames, STREAM_CHUNK_SIZE))):
+            print(f"{name}, {layout}:")
+            expected = bench("iter_lines + json.loads", baseline, chunks)
+            got = bench("StreamDecoder", lambda c: decoder_text(c, sse), chunks)
+            assert got == expected, "decoders disagree"
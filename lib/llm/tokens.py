@@ -0,0 +1,200 @@
+import math
+import os
+import re
+from functools import lru_cache
+
+# Optional exact tokenizers. Neither is a hard dependency: when a vocabulary
+# for the model can't be loaded we fall back to the calibrated heuristic below.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+
+# Directory holding HuggingFace `tokenizer.json` files, one per model, named after
+# the model with ':' and '/' replaced by '_' (e.g. "devstral_latest.json").
+TOKENIZER_CACHE_DIR = os.environ.get(
+    "AGENT_TERMINAL_TOKENIZERS",
+    os.path.join(os.path.expanduser("~"), ".cache", "agent-terminal", "tokenizers")
+)
+
+# Context window per model family, matched on the model name prefix (after any
+# "namespace/" part and without the ":tag"). Longest prefix wins.
+CONTEXT_LENGTHS = {
+    "devstral": 131072,
+    "gemma3": 131072,
+    "gemma2": 8192,
+    "llama3.1": 131072,
+    "llama3.2": 131072,
+    "llama3": 8192,
+    "mistral": 32768,
+    "qwen2.5": 32768,
+    "gpt-4o": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_LENGTH = 4096
+
+# Tokens kept free for the answer when the caller doesn't set max_tokens
+DEFAULT_COMPLETION_RESERVE = 512
+# Chat template overhead (role markers, separators) per message
+MESSAGE_OVERHEAD_TOKENS = 8
+
+# One match per "piece" a BPE pre-tokenizer would produce: words, numbers,
+# single punctuation characters and line breaks.
+_PIECE_RE = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|\n")
+# Pieces long enough to be split into several BPE tokens
+_LONG_WORD_RE = re.compile(r"[^\W\d_]{7,}")
+_LONG_NUMBER_RE = re.compile(r"\d{4,}")
+
+
+def _model_key(model_name: str) -> str:
+    name = model_name.split("/")[-1]
+    return name.split(":")[0].lower()
+
+
+def context_length_for(model_name: str) -> int:
+    """
+    Looks up the context window of a model by its family name.
+
+    Args:
+        model_name (str): Model id, e.g. "devstral:latest" or "ai/gemma3:latest".
+
+    Returns:
+        int: The context length in tokens, or DEFAULT_CONTEXT_LENGTH if the family is unknown.
+    """
+    key = _model_key(model_name)
+    best = ""
+    for prefix in CONTEXT_LENGTHS:
+        if key.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    return CONTEXT_LENGTHS[best] if best else DEFAULT_CONTEXT_LENGTH
+
+
+def heuristic_token_count(text: str) -> int:
+    """
+    Estimates the number of BPE tokens in a text without a vocabulary.
+
+    Every word, number, punctuation mark and newline counts as one token, and
+    long words/numbers add one token per extra 4 (resp. 3) characters.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The estimated token count.
+    """
+    if not text:
+        return 0
+    count = len(_PIECE_RE.findall(text))
+    for word in _LONG_WORD_RE.findall(text):
+        count += (len(word) - 3) // 4
+    for number in _LONG_NUMBER_RE.findall(text):
+        count += (len(number) - 1) // 3
+    return count
+
+
+class TokenEstimator:
+    """
+    Fast local token counter for one model.
+
+    Uses the model's BPE vocabulary when one can be loaded (tiktoken for OpenAI
+    models, a cached `tokenizer.json` otherwise), and the heuristic counter
+    scaled by a per-model calibration factor learned from server usage reports.
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.encoder = _load_encoder(model_name)
+        self.ratio = 1.0  # actual / heuristic, learned by calibrate()
+
+    @property
+    def exact(self) -> bool:
+        return self.encoder is not None
+
+    def _encode(self, text: str) -> list[int]:
+        if tiktoken is not None and isinstance(self.encoder, tiktoken.Encoding):
+            return self.encoder.encode(text, disallowed_special=())
+        return self.encoder.encode(text, add_special_tokens=False).ids
+
+    def count(self, text: str) -> int:
+        """Returns the (estimated) number of tokens in `text`."""
+        if not text:
+            return 0
+        if self.encoder is not None:
+            return len(self._encode(text))
+        return math.ceil(heuristic_token_count(text) * self.ratio)
+
+    def calibrate(self, text: str, actual_tokens: int) -> None:
+        """
+        Adjusts the heuristic using a token count reported by the server.
+
+        Args:
+            text (str): The text that was sent.
+            actual_tokens (int): The prompt token count the server reported for it.
+        """
+        if self.encoder is not None or not actual_tokens:
+            return
+        estimate = heuristic_token_count(text)
+        if estimate < 32:
+            return  # too short to say anything about the ratio
+        observed = actual_tokens / estimate
+        # Exponential moving average so a single odd prompt doesn't swing it
+        self.ratio = 0.7 * self.ratio + 0.3 * observed
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Cuts `text` down to about `max_tokens` tokens, keeping its end.
+
+        The end is kept because the question usually follows the file content,
+        and with logs the most recent lines are the relevant ones.
+        """
+        if max_tokens <= 0:
+            return ""
+        if self.encoder is not None:
+            ids = self._encode(text)
+            if len(ids) <= max_tokens:
+                return text
+            return self.encoder.decode(ids[-max_tokens:])
+
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        # Cut proportionally, then shave off more until the estimate fits
+        keep = int(len(text) * max_tokens / total)
+        truncated = text[-keep:] if keep else ""
+        while truncated and self.count(truncated) > max_tokens:
+            keep = int(keep * 0.95)
+            truncated = text[-keep:] if keep else ""
+        return truncated
+
+
+def _load_encoder(model_name: str):
+    if tiktoken is not None:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except (KeyError, ValueError):
+            pass
+        except Exception:
+            pass  # vocabulary download failed, e.g. offline
+
+    if Tokenizer is not None:
+        filename = re.sub(r"[:/]", "_", model_name) + ".json"
+        path = os.path.join(TOKENIZER_CACHE_DIR, filename)
+        if os.path.isfile(path):
+            try:
+                return Tokenizer.from_file(path)
+            except Exception as e:
+                print(f"Warning: could not load tokenizer {path}: {e}")
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_estimator(model_name: str) -> TokenEstimator:
+    """Returns the shared TokenEstimator for a model (vocabularies are loaded once)."""
+    return TokenEstimator(model_name)
@@ -0,0 +1,206 @@
+import threading
+import time
+
+from lib.ledger import UsageLedger
+from lib.llm.basellm import BaseApiLLM
+from lib.llm.tokens import DEFAULT_COMPLETION_RESERVE, MESSAGE_OVERHEAD_TOKENS
+
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+SUMMARIZE_PROMPT = (
+    "Summarize the conversation above for your own later reference. Keep facts, decisions, "
+    "names, file paths, commands and open questions; drop pleasantries. Answer with the summary only."
+)
+
+
+class Message:
+    """One conversation message with its token count, computed once when it is added."""
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: int):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+    def as_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
+class ConversationMemory:
+    """
+    Conversation history for multi-turn use, sent as a token-budgeted window.
+
+    Every request gets the newest messages that fit `budget` (and the model
+    context), preceded by a summary of the older ones. Once the messages not
+    yet summarized pass `summarize_at` of the budget, all but the `keep_recent`
+    newest are folded into the summary by `summarizer` on a background thread,
+    so the next prompt never waits for it; until the summary lands the oldest
+    messages simply fall out of the window. Summarized messages are dropped.
+    A pinned message and the ones after it are never summarized.
+
+    Args:
+        api (BaseApiLLM): API the conversation is sent to (token counts and context length).
+        summarizer (BaseApiLLM, optional): Cheaper model that writes the summaries (default: `api`).
+        budget (int, optional): Tokens of history sent per request (default: half the context).
+        keep_recent (int): Newest messages that are never summarized.
+        summarize_at (float): Fraction of the budget that starts a summary.
+        summary_tokens (int): Length limit of a summary.
+        ledger (UsageLedger, optional): Records the summary requests.
+        summarizer_name (str): API name of the summarizer, for the ledger.
+    """
+
+    def __init__(self, api: BaseApiLLM, summarizer: BaseApiLLM = None, budget: int | None = None,
+                 keep_recent: int = 4, summarize_at: float = 0.75, summary_tokens: int = 400,
+                 ledger: UsageLedger = None, summarizer_name: str = ""):
+        self.api = api
+        self.summarizer = summarizer or api
+        self.ledger = ledger
+        self.summarizer_name = summarizer_name
+        self.budget = budget or api.params["context_length"] // 2
+        self.keep_recent = keep_recent
+        self.summarize_at = summarize_at
+        self.summary_tokens = summary_tokens
+        self.lock = threading.Lock()
+        self.messages: list[Message] = []
+        self.unsummarized_tokens = 0
+        self.summary: Message | None = None
+        self.pinned: Message | None = None
+        self.summarizing: threading.Thread | None = None
+        self.generation = 0  # bumped by clear() so a running summary of old messages is discarded
+        self.tokens_used = 0  # spent on summaries
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, role: str, content: str) -> None:
+        message = Message(role, content, self.api.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS)
+        with self.lock:
+            self.messages.append(message)
+            self.unsummarized_tokens += message.tokens
+            if self.summarizing is None and self.unsummarized_tokens > self.budget * self.summarize_at:
+                self._start_summary()
+
+    def add_turn(self, prompt: str, answer: str) -> None:
+        self.add("user", prompt)
+        self.add("assistant", answer)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.messages = []
+            self.unsummarized_tokens = 0
+            self.summary = None
+            self.pinned = None
+            self.generation += 1
+
+    def pin(self, message: Message | None) -> None:
+        """Keeps `message` and everything after it verbatim: only older messages are summarized."""
+        with self.lock:
+            self.pinned = message
+
+    def find(self, role: str, content: str) -> Message | None:
+        """The newest message with this role and content, if it is still held verbatim."""
+        with self.lock:
+            for message in reversed(self.messages):
+                if message.role == role and message.content == content:
+                    return message
+        return None
+
+    def holds(self, message: Message | None, prompt: str, max_tokens: int | None = None) -> bool:
+        """Whether `message` is still held verbatim and would be sent in the window before `prompt`."""
+        if message is None:
+            return False
+        available = self._available(prompt, max_tokens)
+        with self.lock:
+            _, start = self._fit(available)
+            return any(m is message for m in self.messages[start:])
+
+    def window(self, prompt: str, max_tokens: int | None = None) -> list[dict]:
+        """
+        Messages to send as history before `prompt`: the summary (as the system
+        message) and the newest messages that fit the budget.
+        """
+        api = self.api
+        available = self._available(prompt, max_tokens)
+        with self.lock:
+            history = []
+            with_summary, start = self._fit(available)
+            if with_summary:
+                history.append({"role": "system",
+                                "content": f"{api.params['system_prompt']}\n\n{SUMMARY_HEADER}{self.summary.content}"})
+            history += [m.as_dict() for m in self.messages[start:]]
+        return history
+
+    def _available(self, prompt: str, max_tokens: int | None) -> int:
+        """Tokens of history that can be sent with `prompt`."""
+        api = self.api
+        reserve = max_tokens if max_tokens else DEFAULT_COMPLETION_RESERVE
+        system_tokens = api.count_tokens(api.params["system_prompt"]) + MESSAGE_OVERHEAD_TOKENS
+        return min(self.budget, api.params["context_length"] - reserve - system_tokens
+                   - api.count_tokens(prompt) - MESSAGE_OVERHEAD_TOKENS)
+
+    def _fit(self, available: int) -> tuple[bool, int]:
+        """(whether the summary fits, index of the oldest message sent). Called with the lock held."""
+        with_summary = self.summary is not None and self.summary.tokens <= available
+        if with_summary:
+            available -= self.summary.tokens
+        start = len(self.messages)
+        while start > 0 and self.messages[start - 1].tokens <= available:
+            start -= 1
+            available -= self.messages[start].tokens
+        # Start on a user turn, chat templates expect user/assistant alternation
+        while start < len(self.messages) and self.messages[start].role != "user":
+            start += 1
+        return with_summary, start
+
+    # Background summarization #####################################################################
+
+    def _start_summary(self) -> None:
+        """Folds all but the newest messages into the summary. Called with the lock held."""
+        end = len(self.messages) - self.keep_recent
+        for i, message in enumerate(self.messages[:end]):
+            if message is self.pinned:
+                end = i
+                break
+        if end <= 0:
+            return
+        folded = self.messages[:end]
+        previous = self.summary.content if self.summary else ""
+        self.summarizing = threading.Thread(target=self._summarize, args=(folded, previous, self.generation),
+                                            name="memory-summarizer", daemon=True)
+        self.summarizing.start()
+
+    def _summarize(self, folded: list[Message], previous: str, generation: int) -> None:
+        summary = None
+        try:
+            transcript = "\n\n".join(f"{m.role}: {m.content}" for m in folded)
+            if previous:
+                transcript = f"{SUMMARY_HEADER}{previous}\n\n{transcript}"
+            # The instruction goes last: truncation keeps the end of the prompt
+            prompt = self.summarizer.fit_prompt(f"{transcript}\n\n{SUMMARIZE_PROMPT}",
+                                                max_tokens=self.summary_tokens, overflow="truncate")
+            if prompt:
+                started = time.perf_counter()
+                try:
+                    result = self.summarizer.generate_text(prompt, stream=False, max_tokens=self.summary_tokens)
+                except Exception as e:
+                    self._record_usage(None, started, error=type(e).__name__)
+                    raise
+                self._record_usage(result, started)
+                if result and result.get("text") and not result.get("stopped"):
+                    summary = result["text"].strip()
+                    self.tokens_used += result.get("total_tokens", 0)
+        finally:
+            with self.lock:
+                self.summarizing = None
+                if summary and generation == self.generation:
+                    self.summary = Message("system", summary,
+                                           self.api.count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS)
+                    del self.messages[:len(folded)]  # only appended to since, unless cleared
+                    self.unsummarized_tokens -= sum(m.tokens for m in folded)
+                    # Turns added while summarizing may already call for the next summary
+                    if self.unsummarized_tokens > self.budget * self.summarize_at:
+                        self._start_summary()
+
+    def _record_usage(self, result: dict | None, started: float, error: str | None = None) -> None:
+        if self.ledger is not None:
+            self.ledger.record_result(self.summarizer_name, self.summarizer, result,
+                                      time.perf_counter() - started, error=error)
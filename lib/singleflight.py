@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from lib.llm.deadline import Deadline
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process deduplication
+    fcntl = None
+
+
+def default_rendezvous_dir() -> str:
+    """Directory where processes meet to share in-flight generations."""
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else "user"
+    return os.path.join(base, f"agent-terminal-{uid}", "inflight")
+
+
+def _partial_result(pieces: list[str], stopped: str) -> dict:
+    """Result of a follower that stopped waiting, with the text received so far."""
+    return {"text": "".join(pieces), "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+            "stopped": stopped, "ttft": None, "error": None}
+
+
+def _wait_timeout(deadline: Deadline | None, got_piece: bool) -> float | None:
+    """Seconds a follower may still wait: the first-token budget until a piece arrived, then the total."""
+    if deadline is None:
+        return None
+    return deadline.remaining() if got_piece else deadline.first_token_timeout()
+
+
+def request_key(backend: str, base_url: str, model: str, system_prompt: str, prompt: str,
+                max_tokens: int | None = None, history: list[dict] | None = None) -> str:
+    """Hashes everything that determines the answer of a request into a flight key."""
+    fields = [backend, base_url, model, system_prompt, prompt, max_tokens, history or []]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """One generation in progress in this process, with the pieces streamed so far."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pieces: list[str] = []
+        self.result: dict | None = None
+        self.done = False
+
+    def publish(self, piece: str):
+        with self.cond:
+            self.pieces.append(piece)
+            self.cond.notify_all()
+
+    def finish(self, result: dict | None):
+        with self.cond:
+            self.result = result
+            self.done = True
+            self.cond.notify_all()
+
+    def follow(self, on_token=None, deadline: Deadline = None) -> dict | None:
+        """Replays the pieces and returns the result; stops early at the deadline or on Ctrl-C."""
+        index = 0
+        try:
+            while True:
+                with self.cond:
+                    while index == len(self.pieces) and not self.done:
+                        timeout = _wait_timeout(deadline, index > 0)
+                        if timeout is not None and timeout <= 0:
+                            print("\n[single-flight] timed out waiting for the shared answer.")
+                            return _partial_result(self.pieces[:index], "timeout")
+                        self.cond.wait(timeout)
+                    pieces = self.pieces[index:]
+                    index = len(self.pieces)
+                    done = self.done
+                if on_token is not None:
+                    for piece in pieces:
+                        on_token(piece)
+                if done:
+                    return self.result
+        except KeyboardInterrupt:
+            print("\nCancelled, stopped waiting for the shared answer.")
+            return _partial_result(self.pieces[:index], "cancelled")
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent requests into one generation.
+
+    The first caller for a key runs the generation; callers with the same key
+    that arrive while it runs (threads of this process, or other processes
+    sharing the rendezvous directory) receive the same streamed pieces and the
+    same final result instead of starting their own.
+
+    Across processes the leader holds an flock on `<key>.lock` and appends the
+    pieces as NDJSON lines to `<key>.ndjson`, which followers tail.
+    """
+
+    POLL_INTERVAL = 0.01
+    ATTACH_TIMEOUT = 2.0  # how long a follower waits for the leader's stream file
+
+    def __init__(self, rendezvous_dir: str | None = None):
+        self.rendezvous_dir = rendezvous_dir or default_rendezvous_dir()
+        self.lock = threading.Lock()
+        self.flights: dict[str, _Flight] = {}
+        if fcntl is not None:
+            os.makedirs(self.rendezvous_dir, mode=0o700, exist_ok=True)
+
+    def do(self, key: str, generate, on_token=None, deadline: Deadline = None) -> dict | None:
+        """
+        Runs `generate(on_token)` once per key among all concurrent callers.
+
+        Args:
+            key (str): Flight key, see request_key().
+            generate (callable): Called as generate(publish) by the leader; must call
+                publish(piece) for each streamed piece and return the result dict.
+            on_token (callable, optional): Receives every streamed piece.
+            deadline (Deadline, optional): Bounds how long a follower waits for the leader
+                (the leader's generate applies it itself).
+
+        Returns:
+            dict | None: The result of the generation. Followers get a copy with "shared": True;
+                a follower that stops waiting (deadline, Ctrl-C) gets the text so far with
+                "stopped" set to "timeout" or "cancelled".
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+
+        if not leader:
+            result = flight.follow(on_token, deadline)
+            return dict(result, shared=True) if result is not None else None
+
+        def publish(piece: str):
+            flight.publish(piece)
+            if on_token is not None:
+                on_token(piece)
+
+        result = None
+        try:
+            if fcntl is None:
+                result = generate(publish)
+            else:
+                result = self._run_across_processes(key, generate, publish, deadline)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.finish(result)
+        return result
+
+    # Cross-process rendezvous ###########################################################
+
+    def _run_across_processes(self, key: str, generate, publish, deadline: Deadline = None) -> dict | None:
+        lock_path = os.path.join(self.rendezvous_dir, f"{key}.lock")
+        stream_path = os.path.join(self.rendezvous_dir, f"{key}.ndjson")
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            attach_deadline = time.monotonic() + self.ATTACH_TIMEOUT
+            while True:
+                locked = self._try_lock(lock_fd)
+                if not locked:
+                    stream = self._attach(lock_fd, stream_path)
+                    if stream is not None:
+                        result = self._tail(stream, lock_fd, publish, deadline)
+                        if result is not None:
+                            return dict(result, shared=True)
+                        # The leader exited without a result and we now hold the lock
+                        print("\n[single-flight] shared generation was interrupted, generating again.")
+                        locked = True
+                if locked:
+                    if not self._is_current(lock_fd, lock_path):
+                        # The previous leader finished and removed this lock file: a newcomer may
+                        # already lead on the new one, so compete for that instead
+                        os.close(lock_fd)
+                        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+                        continue
+                    return self._lead(lock_fd, lock_path, stream_path, generate, publish)
+                if time.monotonic() > attach_deadline:
+                    # Leader never published a stream, don't wait on it any longer
+                    return generate(publish)
+                if deadline is not None and _wait_timeout(deadline, False) <= 0:
+                    print("\n[single-flight] timed out waiting for the shared answer.")
+                    return _partial_result([], "timeout")
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            os.close(lock_fd)  # also releases the flock
+
+    @staticmethod
+    def _try_lock(lock_fd: int) -> bool:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @staticmethod
+    def _is_current(lock_fd: int, lock_path: str) -> bool:
+        """Whether lock_fd is still the file at lock_path (leaders unlink it when done)."""
+        try:
+            return os.fstat(lock_fd).st_ino == os.stat(lock_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _lead(self, lock_fd: int, lock_path: str, stream_path: str, generate, publish) -> dict | None:
+        token = f"{os.getpid()}-{uuid.uuid4().hex}"
+        tmp_path = f"{stream_path}.{token}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            stream.write(json.dumps({"token": token}) + "\n")
+            stream.flush()
+            os.replace(tmp_path, stream_path)
+            # Followers only trust a stream whose header matches the lock file token
+            os.ftruncate(lock_fd, 0)
+            os.pwrite(lock_fd, token.encode(), 0)
+
+            def publish_shared(piece: str):
+                stream.write(json.dumps({"p": piece}) + "\n")
+                stream.flush()
+                publish(piece)
+
+            result = None
+            try:
+                result = generate(publish_shared)
+            finally:
+                if result is not None:
+                    stream.write(json.dumps({"done": True, "result": result}) + "\n")
+                    stream.flush()
+                # Remove both files while still holding the lock, so the directory doesn't
+                # grow with every distinct prompt. Followers keep their open descriptors.
+                for path in (stream_path, lock_path):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        return result
+
+    @staticmethod
+    def _attach(lock_fd: int, stream_path: str):
+        try:
+            token = os.pread(lock_fd, 256, 0).decode()
+            stream = open(stream_path, "r", encoding="utf-8")
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+        header = stream.readline()
+        try:
+            if header.endswith("\n") and json.loads(header).get("token") == token:
+                return stream
+        except json.JSONDecodeError:
+            pass
+        stream.close()
+        return None
+
+    def _tail(self, stream, lock_fd: int, publish, deadline: Deadline = None) -> dict | None:
+        """
+        Replays the leader's stream file; returns None if the leader died before finishing.
+
+        Stops at the deadline or on Ctrl-C with the text received so far.
+        """
+        received = []
+        with stream:
+            partial = ""
+            leader_gone = False
+            try:
+                while True:
+                    line = stream.readline()
+                    if line:
+                        partial += line
+                        if not partial.endswith("\n"):
+                            continue  # the leader is mid-write
+                        record = json.loads(partial)
+                        partial = ""
+                        if record.get("done"):
+                            return record["result"]
+                        received.append(record["p"])
+                        publish(record["p"])
+                        continue
+                    if leader_gone:
+                        return None
+                    # At EOF: if we can take the lock the leader has finished or died.
+                    # Read once more after taking it, as the final line may have just landed.
+                    if self._try_lock(lock_fd):
+                        leader_gone = True
+                        continue
+                    timeout = _wait_timeout(deadline, bool(received))
+                    if timeout is not None and timeout <= 0:
+                        print("\n[single-flight] timed out waiting for the shared answer.")
+                        return _partial_result(received, "timeout")
+                    time.sleep(self.POLL_INTERVAL)
+            except KeyboardInterrupt:
+                print("\nCancelled, stopped waiting for the shared answer.")
+                return _partial_result(received, "cancelled")
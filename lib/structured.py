@@ -0,0 +1,172 @@
+import json
+
+from lib.agent import BaseAgent
+from lib.llm.basellm import BaseApiLLM
+from lib.llm.deadline import Deadline
+from lib.llm.stream import StopStream
+
+# Answer shape for "give me the command to do X". The command comes first so it
+# is complete, and the generation can be stopped, before the explanation starts.
+COMMAND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "command": {"type": "string", "description": "The shell command line"},
+        "explanation": {"type": "string", "description": "One sentence on what the command does"}
+    },
+    "required": ["command", "explanation"],
+    "additionalProperties": False  # required by OpenAI strict mode
+}
+
+COMMAND_PROMPT = """Give the shell command that does what the user asks, for this system:
+{system_info}
+
+Answer with JSON: {{"command": "<the command line>", "explanation": "<one sentence>"}}
+
+{question}"""
+
+
+def build_command_prompt(api: BaseApiLLM, question: str, system_info: str, max_tokens: int | None = None,
+                         overflow: str = "truncate") -> str | None:
+    """
+    COMMAND_PROMPT for `question`, which is fitted to the context on its own first.
+
+    Truncating the whole prompt would keep its end and cut the instructions at
+    the start, so only the question (e.g. a long file) is cut down.
+
+    Returns:
+        str | None: The prompt, or None if the question was rejected.
+    """
+    instructions = COMMAND_PROMPT.format(system_info=system_info, question="")
+    # Counted like an earlier message, which leaves a few tokens of margin
+    question = api.fit_prompt(question, max_tokens=max_tokens, overflow=overflow,
+                              history=[{"role": "user", "content": instructions}])
+    if question is None:
+        return None
+    return COMMAND_PROMPT.format(system_info=system_info, question=question)
+
+
+class JsonFieldWatcher:
+    """
+    Finds the top-level fields of a JSON object while it is being streamed.
+
+    feed() scans only the new characters, tracking nesting and strings, and
+    returns the fields whose value completed in that piece. A string, object or
+    array value is complete at its closing quote or bracket; a number, true,
+    false or null at the next top-level "," or "}".
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0  # next character to scan
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_string = None  # last top-level string, the key if a ":" follows
+        self.key = None  # key whose value is being read
+        self.value_start = None
+        self.fields: dict = {}
+
+    def feed(self, piece: str) -> dict:
+        self.buffer += piece
+        completed = {}
+        buffer = self.buffer
+        for i in range(self.pos, len(buffer)):
+            c = buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        if self.key is not None and self.value_start == self.string_start:
+                            self._complete(buffer[self.string_start:i + 1], completed)
+                        elif self.key is None:
+                            self.last_string = buffer[self.string_start:i + 1]
+                continue
+            if c == '"':
+                self.in_string = True
+                self.string_start = i
+                if self.depth == 1 and self.key is not None and self.value_start is None:
+                    self.value_start = i
+            elif c in "{[":
+                self.depth += 1
+                if self.depth == 2 and self.key is not None and self.value_start is None:
+                    self.value_start = i
+            elif c in "}]":
+                self.depth -= 1
+                if self.key is not None and self.value_start is not None:
+                    if self.depth == 1:  # an object or array value closed
+                        self._complete(buffer[self.value_start:i + 1], completed)
+                    elif self.depth == 0:  # the whole object closed after a number, true, false or null
+                        self._complete(buffer[self.value_start:i], completed)
+            elif self.depth == 1:
+                if c == ":" and self.key is None and self.last_string is not None:
+                    self.key = json.loads(self.last_string)
+                    self.last_string = None
+                elif c == ",":
+                    if self.key is not None and self.value_start is not None:
+                        self._complete(buffer[self.value_start:i], completed)
+                    self.key = None
+                    self.value_start = None
+                elif self.key is not None and self.value_start is None and not c.isspace():
+                    self.value_start = i  # number, true, false or null
+        self.pos = len(buffer)
+        return completed
+
+    def _complete(self, raw: str, completed: dict) -> None:
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            return
+        self.fields[self.key] = value
+        completed[self.key] = value
+        self.key = None
+        self.value_start = None
+
+
+def ask_structured(agent: BaseAgent, prompt: str, schema: dict, stop_after: tuple[str, ...] = (),
+                   on_field=None, max_tokens: int | None = None, overflow: str = "truncate",
+                   timeout: str | None = None) -> dict | None:
+    """
+    Asks for a JSON answer matching `schema` and returns its fields as they stream in.
+
+    Args:
+        agent (BaseAgent): Agent with the API to use already active.
+        prompt (str): The prompt, which should describe the expected JSON.
+        schema (dict): JSON schema of the answer (Ollama `format`, OpenAI `response_format`).
+        stop_after (tuple[str, ...]): Fields after which the rest of the answer isn't needed;
+            the generation is cancelled as soon as all of them are complete.
+        on_field (callable, optional): Called as on_field(name, value) when a field completes.
+        max_tokens, overflow: As for BaseAgent.generate_response.
+        timeout (str | None): --timeout spec.
+
+    Returns:
+        dict | None: The fields received, or None if the request failed.
+    """
+    watcher = JsonFieldWatcher()
+    wanted = set(stop_after)
+
+    def on_token(piece: str):
+        for name, value in watcher.feed(piece).items():
+            if on_field is not None:
+                on_field(name, value)
+        if wanted and wanted <= watcher.fields.keys():
+            raise StopStream
+
+    deadline = Deadline.parse(timeout) if timeout else None
+    text = agent.generate_response(prompt, stream=True, max_tokens=max_tokens, overflow=overflow, on_token=on_token,
+                                   deadline=deadline, json_schema=schema)
+    if text is None:
+        return None
+    if (agent.last_response_data or {}).get("stopped") is None:
+        # Complete answer: parse it whole, in case the model wrapped the object unexpectedly
+        try:
+            answer = json.loads(text)
+            if isinstance(answer, dict):
+                return answer
+        except json.JSONDecodeError:
+            pass
+    return watcher.fields
@@ -0,0 +1,289 @@
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.agent import BaseAgent
+from lib.llm.basellm import BaseApiLLM
+from lib.llm.deadline import Deadline
+from lib.llm.tokens import get_estimator, DEFAULT_COMPLETION_RESERVE
+from lib.utils.system import get_system_info
+from lib.utils.text import colorize
+
+RUN_COMMAND_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_command",
+        "description": "Run a shell command on the user's machine. Returns its exit code and combined "
+                       "stdout/stderr (long output is cut to its end). Commands requested in the same "
+                       "answer run in parallel.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "command": {"type": "string", "description": "The shell command line to run"}
+            },
+            "required": ["command"]
+        }
+    }
+}
+
+AGENT_PROMPT = """You are a terminal assistant working on the user's machine.
+Use the run_command tool to inspect the system and carry out the user's task.
+Request every command you need at once when they don't depend on each other's output, they run in parallel.
+Prefer read-only commands, and never run anything destructive unless the task asks for it.
+When you have the answer, reply to the user without calling tools. Be concise. Don't use markdown to reply.
+
+{system_info}"""
+
+MAX_CAPTURE_BYTES = 1 << 20 # Output kept per command; the rest is only shown on the terminal
+OUTPUT_GRACE = 0.5 # Seconds output may stay open and quiet after the command exited (e.g. `cmd &`)
+POLL_INTERVAL = 0.1
+PANE_COLORS = ["green", "blue", "yellow", "red"]
+
+
+class CommandResult:
+    """Outcome of one shell command run for the model."""
+
+    def __init__(self, command: str):
+        self.command = command
+        self.output = ""
+        self.exit_code = None
+        self.timed_out = False
+        self.duration = 0.0
+
+    def as_tool_output(self, api: BaseApiLLM, token_budget: int) -> str:
+        """Exit status and output for the model, keeping the end of the output that fits `token_budget`."""
+        status = f"exit code: {self.exit_code}"
+        if self.timed_out:
+            status += f" (killed after {self.duration:.1f}s timeout)"
+        output = self.output
+        estimator = get_estimator(api.model_name)
+        if estimator.count(output) > token_budget:
+            output = f"[... start of the output omitted ...]\n{estimator.truncate(output, token_budget)}"
+        return f"{status}\n{output}" if output else status
+
+
+class CommandRunner:
+    """
+    Runs shell commands concurrently in a bounded pool.
+
+    Each command runs in its own process group and is killed with its children
+    after `timeout` seconds. Output lines are printed as they arrive, prefixed
+    with the command number, and captured for the model. Reading stops at the
+    timeout too, or shortly after the command exits even if a background child
+    it started still holds the output open.
+    """
+
+    def __init__(self, jobs: int = 4, timeout: float = 30.0):
+        self.pool = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="command")
+        self.timeout = timeout
+        self.print_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.processes: set[subprocess.Popen] = set()
+
+    def run_all(self, commands: list[str]) -> list[CommandResult]:
+        futures = [self.pool.submit(self._run, i, command) for i, command in enumerate(commands, 1)]
+        try:
+            return [future.result() for future in futures]
+        except KeyboardInterrupt:
+            self.kill_all()
+            raise
+
+    def kill_all(self) -> None:
+        with self.lock:
+            for process in list(self.processes):
+                _kill_group(process)
+
+    def shutdown(self) -> None:
+        self.kill_all()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, index: int, command: str) -> CommandResult:
+        result = CommandResult(command)
+        prefix = colorize(f"[{index}]", PANE_COLORS[(index - 1) % len(PANE_COLORS)])
+        start = time.monotonic()
+        try:
+            process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            result.output = f"could not start the command: {e}"
+            return result
+
+        with self.lock:
+            self.processes.add(process)
+        # The reader thread closes the pipe at EOF; it may outlive this call if a
+        # detached child (setsid, nohup) keeps the pipe open
+        lines: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=_read_lines, args=(process.stdout, lines), name=f"command-{index}-output",
+                         daemon=True).start()
+        deadline = start + self.timeout
+        exited_at = None
+        captured = bytearray()
+        try:
+            while True:
+                try:
+                    line = lines.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    line = b""
+                if line is None:  # EOF
+                    break
+                if line:
+                    if len(captured) < MAX_CAPTURE_BYTES:
+                        captured += line
+                    with self.print_lock:
+                        print(f"{prefix} {line.decode('utf-8', errors='replace').rstrip()}", flush=True)
+                now = time.monotonic()
+                if process.poll() is None:
+                    if now > deadline and not result.timed_out:
+                        result.timed_out = True
+                        _kill_group(process)
+                    continue
+                if exited_at is None or line:
+                    exited_at = now  # quiet period restarts with every line
+                elif now - exited_at > OUTPUT_GRACE or now > deadline:
+                    break  # output held open by a background child
+            try:
+                result.exit_code = process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:  # closed its output but kept running
+                result.timed_out = True
+                _kill_group(process)
+                result.exit_code = process.wait()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        result.output = captured[:MAX_CAPTURE_BYTES].decode("utf-8", errors="replace")
+        result.duration = time.monotonic() - start
+        with self.print_lock:
+            status = "timed out" if result.timed_out else f"exit {result.exit_code}"
+            print(f"{prefix} {colorize(f'-- {status} ({result.duration:.1f}s) --', 'blue')}", flush=True)
+        return result
+
+
+def _read_lines(stream, lines: queue.SimpleQueue) -> None:
+    """Puts every line of `stream` on `lines`, then None, and closes the stream."""
+    try:
+        for line in stream:
+            lines.put(line)
+    except (OSError, ValueError):
+        pass
+    finally:
+        lines.put(None)
+        stream.close()
+
+
+def _kill_group(process: subprocess.Popen) -> None:
+    """Kills a command started by CommandRunner along with anything it spawned."""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def confirm_commands(commands: list[str]) -> set[int]:
+    """
+    Shows the commands the model wants to run and asks which may run.
+
+    Returns:
+        set[int]: Indexes (0-based) of the approved commands.
+    """
+    print(colorize(f"\n[agent] the model wants to run {len(commands)} command(s):", "yellow"))
+    for i, command in enumerate(commands, 1):
+        print(f"  [{i}] {command}")
+    try:
+        answer = input(colorize("Run them? [y]es / [N]o / numbers to run, e.g. 1,3: ", "yellow")).strip().lower()
+    except EOFError:
+        return set()
+    if answer in ("y", "yes"):
+        return set(range(len(commands)))
+    approved = set()
+    for part in answer.replace(" ", ",").split(","):
+        if part.isdigit() and 1 <= int(part) <= len(commands):
+            approved.add(int(part) - 1)
+    return approved
+
+
+def run_agent(agent: BaseAgent, task: str, max_steps: int = 8, jobs: int = 4, command_timeout: float = 30.0,
+              output_tokens: int = 1000, max_tokens: int | None = None, timeout: str | None = None) -> None:
+    """
+    Lets the model carry out `task` by requesting shell commands as tool calls.
+
+    Every batch of commands the model requests in one answer is shown for
+    confirmation, then the approved ones run in parallel and their outputs go
+    back to the model in the next turn. Stops when the model answers without
+    tool calls, after `max_steps` turns, or on Ctrl-C.
+
+    Args:
+        agent (BaseAgent): Agent whose active API supports tool calls.
+        task (str): What the user wants done.
+        max_steps (int): Model turns allowed.
+        jobs (int): Commands run at the same time.
+        command_timeout (float): Seconds before a command is killed.
+        output_tokens (int): Tokens of each command's output sent back to the model.
+        max_tokens (int | None): Generation limit per model turn.
+        timeout (str | None): --timeout spec, applied to each model turn separately.
+    """
+    api = agent.active_llm_api
+    if not api.supports_tools():
+        print(f"Error: the '{agent.active_api_name}' API does not support tool calls, --agent needs one that does.")
+        return
+    messages = [{"role": "system", "content": AGENT_PROMPT.format(system_info=get_system_info())},
+                {"role": "user", "content": task}]
+    runner = CommandRunner(jobs=jobs, timeout=command_timeout)
+    try:
+        for step in range(1, max_steps + 1):
+            reserve = max_tokens or DEFAULT_COMPLETION_RESERVE
+            if api.count_message_tokens(messages) + reserve > api.params["context_length"]:
+                print(colorize("[agent] the conversation no longer fits the context, stopping.", "red"))
+                return
+
+            deadline = Deadline.parse(timeout) if timeout else None
+            result = agent.chat_with_tools(messages, [RUN_COMMAND_TOOL], max_tokens=max_tokens, deadline=deadline)
+            if result is None:
+                return
+            messages.append(result["message"])
+            calls = result["tool_calls"]
+            if not calls:
+                print(f"\nAI Response:\n{result['text']}")
+                return
+            if result["text"]:
+                print(colorize(result["text"], "blue"))
+
+            commands = []
+            errors = []  # what goes back to the model for calls that can't run
+            for call in calls:
+                arguments = call["arguments"]
+                command = arguments.get("command") if isinstance(arguments, dict) else None
+                if call["name"] != RUN_COMMAND_TOOL["function"]["name"]:
+                    errors.append(f"Unknown tool: {call['name']}")
+                elif not isinstance(command, str) or not command.strip():
+                    errors.append('Invalid arguments, expected {"command": "<shell command line>"}')
+                else:
+                    errors.append(None)
+                commands.append(command if errors[-1] is None else "")
+            approved = confirm_commands([c for c in commands if c]) if any(commands) else set()
+            # confirm_commands numbers only the valid calls; map its answer back to the calls
+            valid = [i for i, c in enumerate(commands) if c]
+            to_run = [valid[i] for i in sorted(approved)]
+            results = dict(zip(to_run, runner.run_all([commands[i] for i in to_run])))
+
+            for i, call in enumerate(calls):
+                if errors[i]:
+                    output = errors[i]
+                elif i in results:
+                    output = results[i].as_tool_output(api, output_tokens)
+                else:
+                    output = "The user declined to run this command."
+                messages.append(api.tool_result_message(call, output))
+            print(colorize(f"[agent] step {step}: {len(results)} of {len(calls)} command(s) run", "blue"))
+
+        print(colorize(f"[agent] stopped after {max_steps} steps without a final answer.", "yellow"))
+    except KeyboardInterrupt:
+        print("\nCancelled.")
+    finally:
+        runner.shutdown()
@@ -0,0 +1,99 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Taken when this module is first imported, which is the first thing lib.ai does,
+# so spans can be reported relative to process start (including the import phase).
+PROCESS_START = time.perf_counter()
+
+
+class Tracer:
+    """
+    Records timed spans and writes them in Chrome trace-event format.
+
+    The file can be opened in chrome://tracing or https://ui.perfetto.dev.
+    While disabled (the default) span() does no timing at all.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: list[dict] = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def add_span(self, name: str, start: float, end: float, **args) -> None:
+        """Records a span from two time.perf_counter() values."""
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "cat": name.split(".")[0],
+            "ph": "X",
+            "ts": (start - PROCESS_START) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """
+        Times the enclosed block as a span.
+
+        Yields the span's args dict, so the block can attach results (counts, sizes) to it.
+        """
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add_span(name, start, time.perf_counter(), **args)
+
+    def write(self, path: str) -> None:
+        """Writes the recorded spans to `path` as a Chrome trace JSON file."""
+        with self.lock:
+            events = list(self.events)
+        thread_names = [
+            {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": t.ident, "args": {"name": t.name}}
+            for t in threading.enumerate()
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": thread_names + events, "displayTimeUnit": "ms"}, f)
+
+
+tracer = Tracer()
+
+
+def span(name: str, **args):
+    """Shortcut for tracer.span()."""
+    return tracer.span(name, **args)
+
+
+def trace_dns(base_url: str) -> None:
+    """
+    Records the host name resolution time of `base_url` as a "dns" span.
+
+    HTTP clients resolve and connect inside a single call, so when tracing we
+    resolve once up front to show the DNS share separately.
+    """
+    if not tracer.enabled:
+        return
+    parsed = urlparse(base_url)
+    with span("dns", host=parsed.hostname):
+        try:
+            socket.getaddrinfo(parsed.hostname, parsed.port or 80, proto=socket.IPPROTO_TCP)
+        except OSError:
+            pass
@@ -0,0 +1,231 @@
+import difflib
+import hashlib
+import os
+import time
+
+from lib.agent import BaseAgent
+from lib.llm.deadline import Deadline
+from lib.memory import ConversationMemory
+from lib.utils.text import colorize
+
+READ_CHUNK = 1 << 20
+
+
+class FileWatcher:
+    """
+    Tracks a file between turns of a watch session and reports what changed.
+
+    A change is an append only if the file still starts with exactly the bytes
+    already sent, checked against a running hash of them, so an earlier edit is
+    never mistaken for an append. Rotation (inode change) or truncation is
+    reported as a full reload; other edits are reported as a unified diff. A
+    file that is deleted, or is mid-way through being replaced, reads as gone.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.25, debounce: float = 1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.inode = None
+        self.size = 0
+        self.mtime = 0.0
+        self.offset = 0  # bytes of the file already sent
+        self.sent_hash = hashlib.blake2b(digest_size=16)  # hash of the first `offset` bytes
+        self.content = ""  # text already sent, kept to diff in-place edits
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _prefix_unchanged(self, f) -> bool:
+        """Whether the file still starts with the `offset` bytes already sent."""
+        prefix = hashlib.blake2b(digest_size=16)
+        f.seek(0)
+        left = self.offset
+        while left > 0:
+            chunk = f.read(min(left, READ_CHUNK))
+            if not chunk:
+                return False
+            prefix.update(chunk)
+            left -= len(chunk)
+        return prefix.digest() == self.sent_hash.digest()
+
+    def load(self) -> str:
+        """
+        Reads the whole file and makes it the baseline for later changes.
+
+        Raises:
+            FileNotFoundError: If the file doesn't exist (anymore).
+        """
+        with open(self.path, "rb") as f:
+            data = f.read()
+            st = os.fstat(f.fileno())
+        self.inode, self.size, self.mtime = st.st_ino, len(data), st.st_mtime_ns
+        self.offset = len(data)
+        self.sent_hash = hashlib.blake2b(data, digest_size=16)
+        self.content = data.decode("utf-8", errors="replace")
+        return self.content
+
+    def wait_for_change(self) -> None:
+        """
+        Blocks until the file changes, then until writes have paused for `debounce` seconds.
+
+        A file that never stops changing is still reported after 5 debounce periods.
+        """
+        last = (self.inode, self.size, self.mtime)
+        while self._stat() in (last, None):
+            time.sleep(self.poll_interval)
+
+        burst_start = time.monotonic()
+        quiet_since = time.monotonic()
+        last = self._stat()
+        while time.monotonic() - quiet_since < self.debounce:
+            if time.monotonic() - burst_start > 5 * self.debounce:
+                break
+            time.sleep(self.poll_interval)
+            current = self._stat()
+            if current != last:
+                last = current
+                quiet_since = time.monotonic()
+
+    def read_update(self) -> tuple[str, str]:
+        """
+        Reads what changed since the last load/update and makes it the new baseline.
+
+        Returns:
+            tuple[str, str]: (kind, text) where kind is
+                "append" (text is the appended part),
+                "diff" (text is a unified diff against the previous content),
+                "reload" (the file was replaced or truncated; text is its full content),
+                "gone" (the file doesn't exist right now; the baseline is kept), or
+                "none" (nothing changed).
+        """
+        try:
+            return self._read_update()
+        except FileNotFoundError:
+            return "gone", ""
+
+    def _read_update(self) -> tuple[str, str]:
+        stat = self._stat()
+        if stat is None:
+            return "gone", ""
+        inode, size, mtime = stat
+        if inode != self.inode or size < self.offset:
+            return "reload", self.load()
+        if (size, mtime) == (self.size, self.mtime):
+            return "none", ""
+
+        with open(self.path, "rb") as f:
+            if self._prefix_unchanged(f):
+                appended = f.read()  # positioned at `offset` by the check
+                self.size, self.mtime = self.offset + len(appended), os.fstat(f.fileno()).st_mtime_ns
+                if not appended:
+                    return "none", ""  # touched, or rewritten with the same content
+                self.offset += len(appended)
+                self.sent_hash.update(appended)
+                text = appended.decode("utf-8", errors="replace")
+                self.content += text
+                return "append", text
+
+        previous = self.content
+        current = self.load()
+        diff = "".join(difflib.unified_diff(previous.splitlines(keepends=True), current.splitlines(keepends=True),
+                                            fromfile="before", tofile="after", n=2))
+        if not diff:
+            return "none", ""
+        if len(diff) >= len(current):
+            return "reload", current
+        return "diff", diff
+
+
+def build_watch_prompt(path: str, kind: str, text: str, question: str) -> str:
+    name = os.path.basename(path)
+    if kind == "append":
+        body = f"New lines were appended to {name} since your last answer:\n{text}"
+    elif kind == "diff":
+        body = f"{name} was edited since your last answer. Unified diff against the version you saw:\n{text}"
+    elif kind == "reload":
+        body = f"{name} was replaced or truncated. Its full new content:\n{text}"
+    else:
+        body = text
+    return f"{body}\n\n{question}" if question else body
+
+
+def run_watch(agent: BaseAgent, path: str, question: str, stream: bool = False, max_tokens: int | None = None,
+              overflow: str = "truncate", timeout: str | None = None, debounce: float = 1.0) -> None:
+    """
+    Re-asks `question` every time `path` changes, sending only the change.
+
+    The conversation (earlier prompts and answers) is kept between turns in the
+    agent's memory, so the server can reuse its cached prefill and only process
+    the new part. Changes are sent relative to the full file the model last saw,
+    which is pinned in the memory so it is never summarized away; once the
+    conversation no longer fits the window with it, the whole file is sent
+    again. Stops on Ctrl-C.
+
+    Args:
+        agent (BaseAgent): Agent with the API to use already active.
+        path (str): File to watch.
+        question (str): Question asked on every change.
+        stream, max_tokens, overflow: As for BaseAgent.generate_response.
+        timeout (str | None): --timeout spec, applied to each turn separately.
+        debounce (float): Seconds without writes before a change is sent.
+    """
+    watcher = FileWatcher(path, debounce=debounce)
+    try:
+        content = watcher.load()
+    except OSError as e:
+        print(f"Error: Could not read file: {path} ({e})")
+        return
+
+    # The file itself is the bulk of the conversation, let it use most of the context
+    api = agent.active_llm_api
+    memory = ConversationMemory(api, budget=api.params["context_length"] * 3 // 4)
+    agent.memory = memory
+    kind, text = "start", content
+    baseline = None  # the memory message holding the full file the model last saw
+    turn = 1
+    while True:
+        api = agent.active_llm_api
+        prompt = build_watch_prompt(path, kind, text, question)
+        if kind in ("append", "diff") and not memory.holds(baseline, prompt, max_tokens):
+            # The version the change is relative to no longer fits the window:
+            # start over from the whole file
+            memory.clear()
+            kind = "restart"
+        full = not len(memory)
+        if full:
+            prompt = f"{watcher.content}\n\n{question}"
+
+        print(colorize(f"\n[watch] turn {turn}: {kind} ({api.count_tokens(prompt)} tokens sent)", "blue"))
+        deadline = Deadline.parse(timeout) if timeout else None
+        response = agent.generate_response(prompt, stream=stream, max_tokens=max_tokens, overflow=overflow,
+                                           deadline=deadline)
+        if response and not stream:
+            print(f"\nAI Response:\n{response}")
+
+        last = agent.last_response_data or {}
+        if last.get("stopped") == "cancelled":
+            return
+        if full:
+            baseline = memory.find("user", prompt)
+            memory.pin(baseline) # Summarizing it would leave the changes without their base
+
+        print(colorize(f"[watch] waiting for changes to {path} (Ctrl-C to stop)", "blue"))
+        try:
+            while True:
+                watcher.wait_for_change()
+                kind, text = watcher.read_update()
+                if kind == "gone":
+                    print(colorize(f"[watch] {path} is gone, waiting for it to come back", "yellow"))
+                elif kind != "none":
+                    break
+        except KeyboardInterrupt:
+            print()
+            return
+        if kind == "reload":
+            memory.clear() # Old content is irrelevant, don't pay for it in the context
+        turn += 1
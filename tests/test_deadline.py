@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+from lib.llm.deadline import Deadline, Watchdog
+
+
+class DeadlineParseTest(unittest.TestCase):
+    def test_total_only(self):
+        deadline = Deadline.parse("120")
+        self.assertEqual((deadline.connect, deadline.first_token, deadline.total), (None, None, 120.0))
+
+    def test_named_budgets(self):
+        deadline = Deadline.parse("connect=5, first=30,total=120.5")
+        self.assertEqual((deadline.connect, deadline.first_token, deadline.total), (5.0, 30.0, 120.5))
+        self.assertEqual(Deadline.parse("first_token=2").first_token, 2.0)
+
+    def test_invalid_specs(self):
+        for spec in ("0", "-1", "first=0", "total=-5", "nan", "soon", "read=5"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                Deadline.parse(spec)
+
+    def test_timeouts_are_bounded_by_the_total(self):
+        deadline = Deadline.parse("connect=5,first=30,total=2")
+        self.assertLessEqual(deadline.connect_timeout(), 2.0)
+        self.assertLessEqual(deadline.first_token_timeout(), 2.0)
+
+
+class WatchdogTest(unittest.TestCase):
+    def armed_budget(self, spec: str) -> str | None:
+        with Deadline.parse(spec).watch(lambda: None) as watchdog:
+            return watchdog.timer.args[0] if watchdog.timer else None
+
+    def test_budget_label(self):
+        self.assertEqual(self.armed_budget("first=2,total=5"), "first_token")
+        self.assertEqual(self.armed_budget("first=5,total=2"), "total")
+        self.assertEqual(self.armed_budget("first=3,total=3"), "total")
+        self.assertEqual(self.armed_budget("first=2"), "first_token")
+        self.assertEqual(self.armed_budget("5"), "total")
+        self.assertIsNone(self.armed_budget("connect=5"))
+
+    def test_first_token_switches_to_the_total_budget(self):
+        with Deadline.parse("first=2,total=5").watch(lambda: None) as watchdog:
+            watchdog.got_token()
+            self.assertEqual(watchdog.timer.args[0], "total")
+
+    def test_fires_with_the_budget_that_ran_out(self):
+        for spec, budget in (("first=0.05,total=10", "first_token"), ("first=10,total=0.05", "total")):
+            closed = threading.Event()
+            with Watchdog(Deadline.parse(spec), closed.set) as watchdog:
+                self.assertTrue(closed.wait(5.0))
+            self.assertEqual(watchdog.fired, budget)
+
+
+if __name__ == "__main__":
+    unittest.main()
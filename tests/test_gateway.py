@@ -0,0 +1,188 @@
+import json
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from lib.agent import BaseAgent
+from lib.gateway import Gateway, Scheduler, parse_address, parse_concurrency
+from lib.llm.basellm import BaseApiLLM
+
+
+class FakeApi(BaseApiLLM):
+    """Backend that streams `pieces` and then returns them, or fails with `error` after them."""
+
+    def __init__(self, pieces=("Hello", " world"), error=None):
+        super().__init__("http://fake", "fake-model")
+        self.pieces = pieces
+        self.error = error
+
+    def generate_text(self, prompt, stream=False, max_tokens=None, on_token=None, deadline=None, history=None,
+                      json_schema=None):
+        if stream and on_token is not None:
+            for piece in self.pieces:
+                on_token(piece)
+        return {"text": "".join(self.pieces), "prompt_tokens": 3, "completion_tokens": len(self.pieces),
+                "total_tokens": 3 + len(self.pieces), "stopped": None, "ttft": 0.01, "error": self.error}
+
+
+class SchedulerTest(unittest.TestCase):
+    def admission_order(self, scheduler: Scheduler, waiters: list[tuple[str, str, str]]) -> list[str]:
+        """Queues the waiters (name, client, priority) one by one, then frees the slots held by "holder"."""
+        order = []
+        threads = []
+
+        def wait(name, client, priority):
+            scheduler.acquire("api", client, priority)
+            order.append(name)
+            scheduler.release("api", client)
+
+        for name, client, priority in waiters:
+            queued = len(scheduler.waiting["api"])
+            thread = threading.Thread(target=wait, args=(name, client, priority), daemon=True)
+            thread.start()
+            threads.append(thread)
+            while len(scheduler.waiting["api"]) == queued:  # keep the arrival order deterministic
+                time.sleep(0.001)
+        for _ in range(scheduler.running["api"]):
+            scheduler.release("api", "holder")
+        for thread in threads:
+            thread.join(5.0)
+        return order
+
+    def test_interactive_before_batch_then_fair_share(self):
+        scheduler = Scheduler({"api": 1})
+        scheduler.acquire("api", "holder")
+        order = self.admission_order(scheduler, [
+            ("c1", "c", "batch"),
+            ("a1", "a", "interactive"),
+            ("a2", "a", "interactive"),
+            ("a3", "a", "interactive"),
+            ("b1", "b", "interactive"),
+            ("b2", "b", "interactive"),
+        ])
+        self.assertEqual(order, ["a1", "b1", "a2", "b2", "a3", "c1"])
+
+    def test_clients_with_running_requests_wait(self):
+        scheduler = Scheduler({"api": 2})
+        for _ in range(3):  # b has been served more than a, but has nothing running
+            scheduler.acquire("api", "b")
+            scheduler.release("api", "b")
+        scheduler.acquire("api", "a")
+        scheduler.acquire("api", "holder")
+        order = []
+
+        def wait(name, client):
+            scheduler.acquire("api", client)
+            order.append(name)
+
+        threads = []
+        for name, client in (("a2", "a"), ("b1", "b")):
+            queued = len(scheduler.waiting["api"])
+            threads.append(threading.Thread(target=wait, args=(name, client), daemon=True))
+            threads[-1].start()
+            while len(scheduler.waiting["api"]) == queued:
+                time.sleep(0.001)
+        scheduler.release("api", "holder")
+        for _ in range(500):
+            if order:
+                break
+            time.sleep(0.01)
+        self.assertEqual(order, ["b1"])
+        scheduler.release("api", "a")
+        for thread in threads:
+            thread.join(5.0)
+        self.assertEqual(order, ["b1", "a2"])
+
+    def test_metrics(self):
+        scheduler = Scheduler({"api": 1})
+        scheduler.acquire("api", "x")
+        scheduler.release("api", "x")
+        metrics = scheduler.metrics()["api"]
+        self.assertEqual((metrics["completed"], metrics["running"], metrics["queue_depth"]), (1, 0, 0))
+
+
+class GatewayHttpTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        agent = BaseAgent({"good": FakeApi(), "down": FakeApi(pieces=(), error="ConnectionError"),
+                           "broken": FakeApi(pieces=("partial",), error="ollama_error")})
+        cls.server = Gateway(agent).make_server("127.0.0.1", 0)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, body) -> tuple[int, bytes]:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url, data=data), timeout=10) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def chat(self, model, content="hi", **extra):
+        return self.post({"model": model, "messages": [{"role": "user", "content": content}], **extra})
+
+    def test_completion(self):
+        status, body = self.chat("good", content=[{"type": "text", "text": "hi "}, {"type": "text", "text": "there"}])
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["choices"][0]["message"]["content"], "Hello world")
+
+    def test_stream(self):
+        status, body = self.chat("good", stream=True)
+        self.assertEqual(status, 200)
+        events = [line[len("data: "):] for line in body.decode().split("\n\n") if line]
+        self.assertEqual(events[-1], "[DONE]")
+        deltas = [json.loads(event)["choices"][0]["delta"] for event in events[:-1]]
+        self.assertEqual("".join(d.get("content", "") for d in deltas), "Hello world")
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post(b"not json")[0], 400)
+        self.assertEqual(self.post({"messages": "hi"})[0], 400)
+        self.assertEqual(self.chat("good", content=5)[0], 400)
+        self.assertEqual(self.chat("good", max_tokens="5")[0], 400)
+        self.assertEqual(self.post({"messages": [{"role": "assistant", "content": "hi"}]})[0], 400)
+
+    def test_unknown_model(self):
+        status, body = self.chat("nope")
+        self.assertEqual((status, json.loads(body)["error"]["type"]), (404, "model_not_found"))
+
+    def test_backend_failure_is_a_502(self):
+        for stream in (False, True):
+            status, body = self.chat("down", stream=stream)
+            self.assertEqual((status, json.loads(body)["error"]["type"]), (502, "backend_error"))
+
+    def test_backend_failure_mid_stream_ends_with_an_error_event(self):
+        status, body = self.chat("broken", stream=True)
+        events = [line[len("data: "):] for line in body.decode().split("\n\n") if line]
+        self.assertEqual(status, 200)
+        self.assertEqual(events[-1], "[DONE]")
+        self.assertEqual(json.loads(events[-2])["error"]["type"], "backend_error")
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_concurrency(self):
+        self.assertEqual(parse_concurrency("ollama=1, openai=4"), {"ollama": 1, "openai": 4})
+        self.assertEqual(parse_concurrency(None), {})
+        for spec in ("ollama=0", "ollama=-1", "ollama", "ollama=x"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_concurrency(spec)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("0.0.0.0:9000"), ("0.0.0.0", 9000))
+        self.assertEqual(parse_address("localhost:"), ("localhost", 8080))
+        self.assertEqual(parse_address(":9000"), ("127.0.0.1", 9000))
+        self.assertEqual(parse_address("9000"), ("127.0.0.1", 9000))
+        self.assertEqual(parse_address("[::1]:9000"), ("::1", 9000))
+        for spec in ("host:http", "host:0", "host:70000"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_address(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
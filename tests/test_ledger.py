@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from lib.ledger import UsageLedger, bucket_of, bucket_value, usage_report
+
+
+class FakeApi:
+    model_name = "m"
+    base_url = "http://10.0.0.1:11434"
+
+
+def result(text="ok", ttft=0.1, **extra):
+    return {"text": text, "prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15, "stopped": None,
+            "ttft": ttft, **extra}
+
+
+class UsageLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "sub", "usage.db")
+        self.ledger = UsageLedger(self.path)
+
+    def tearDown(self):
+        self.ledger.close()
+        self.dir.cleanup()
+
+    def errors(self) -> list[str | None]:
+        self.ledger.close()
+        conn = sqlite3.connect(self.path)
+        try:
+            return [error for error, in conn.execute("SELECT error FROM requests ORDER BY id")]
+        finally:
+            conn.close()
+
+    def test_close_writes_every_queued_row(self):
+        for _ in range(1200):  # more than two batches
+            self.ledger.record("ollama", "m", "http://h:1", result(), 0.5)
+        self.ledger.close()
+        [row] = usage_report(self.path, group_by=("backend",))
+        self.assertEqual((row["requests"], row["prompt_tokens"], row["completion_tokens"]), (1200, 12000, 6000))
+
+    def test_percentiles(self):
+        for ms in range(1, 101):  # 1..100 ms, once each
+            self.ledger.record("ollama", "m", "http://h:1", result(ttft=ms / 2000), ms / 1000)
+        self.ledger.close()
+        [row] = usage_report(self.path, group_by=("model",))
+        for name, exact in (("duration_p50", 50), ("duration_p95", 95), ("duration_p99", 99), ("ttft_p50", 25)):
+            self.assertAlmostEqual(row[name], exact, delta=exact * 0.1, msg=name)
+        self.assertAlmostEqual(row["avg_ms"], 50.5)
+
+    def test_rollups_per_group(self):
+        self.ledger.record("ollama", "a", "http://h1:1", result(), 1.0)
+        self.ledger.record("ollama", "a", "http://h2:1", result(), 1.0)
+        self.ledger.record("openai", "b", "http://h1:1", result(shared=True), 1.0)
+        self.ledger.close()
+        by_host = {row["host"]: row for row in usage_report(self.path, group_by=("host",))}
+        self.assertEqual({host: row["requests"] for host, row in by_host.items()}, {"h1:1": 2, "h2:1": 1})
+        self.assertEqual(by_host["h1:1"]["cache_hits"], 1)
+        self.assertEqual(len(usage_report(self.path, group_by=("day", "backend", "model", "host"))), 3)
+        with self.assertRaises(ValueError):
+            usage_report(self.path, group_by=("user",))
+
+    def test_error_classes(self):
+        api = FakeApi()
+        self.ledger.record_result("ollama", api, result(), 1.0)
+        self.ledger.record_result("ollama", api, None, 1.0)
+        self.ledger.record_result("ollama", api, None, 1.0, error="ReadTimeout")
+        self.ledger.record_result("ollama", api, result(text=""), 1.0)
+        self.ledger.record_result("ollama", api, result(text="", error="ConnectionError"), 1.0)
+        self.ledger.record_result("ollama", api, result(stopped="timeout"), 1.0)
+        self.ledger.record_result("ollama", api, result(stopped="early"), 1.0)
+        self.assertEqual(self.errors(), [None, "no_response", "ReadTimeout", "empty_response", "ConnectionError",
+                                         "timeout", None])
+        [row] = usage_report(self.path, group_by=("host",))
+        self.assertEqual((row["host"], row["requests"], row["errors"]), ("10.0.0.1:11434", 7, 5))
+
+    def test_bucket_value_is_close_to_the_values_it_holds(self):
+        for ms in (1, 7.5, 100, 2500, 60000):
+            self.assertAlmostEqual(bucket_value(bucket_of(ms)), ms, delta=ms * 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
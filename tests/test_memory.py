@@ -0,0 +1,123 @@
+import threading
+import unittest
+
+from lib.llm.basellm import BaseApiLLM
+from lib.llm.tokens import MESSAGE_OVERHEAD_TOKENS
+from lib.memory import SUMMARY_HEADER, ConversationMemory
+
+
+class WordApi(BaseApiLLM):
+    """Counts one token per word; as a summarizer, answers "summary N" once `release` is set."""
+
+    def __init__(self):
+        super().__init__("http://fake", "fake-model")
+        self.prompts = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def generate_text(self, prompt, stream=False, max_tokens=None, on_token=None, deadline=None, history=None,
+                      json_schema=None):
+        self.release.wait(5.0)
+        self.prompts.append(prompt)
+        return {"text": f"summary {len(self.prompts)}", "prompt_tokens": 0, "completion_tokens": 0,
+                "total_tokens": 7, "stopped": None, "ttft": None, "error": None}
+
+
+def words(n: int, tag: str = "w") -> str:
+    return " ".join([tag] * n)
+
+
+class ConversationMemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.api = WordApi()
+        self.summarizer = WordApi()
+        # Messages of words(10) take 18 tokens: the fifth one passes 75% of the budget
+        self.memory = ConversationMemory(self.api, summarizer=self.summarizer, budget=100, keep_recent=2)
+
+    def add_messages(self, count: int, start: int = 0) -> None:
+        for i in range(start, start + count):
+            self.memory.add("user" if i % 2 == 0 else "assistant", words(10, f"m{i}"))
+
+    def wait_for_summary(self) -> None:
+        while self.memory.summarizing is not None:
+            self.memory.summarizing.join(5.0)
+
+    def test_window_keeps_the_newest_messages_that_fit(self):
+        memory = ConversationMemory(self.api, summarizer=self.summarizer, budget=60, summarize_at=10)
+        for i in range(6):
+            memory.add("user" if i % 2 == 0 else "assistant", words(10, f"m{i}"))
+        self.assertEqual(memory.messages[0].tokens, 10 + MESSAGE_OVERHEAD_TOKENS)
+        window = memory.window("question")
+        # Three messages fit, but the window starts on a user turn
+        self.assertEqual([m["content"].split()[0] for m in window], ["m4", "m5"])
+
+    def test_window_leaves_room_for_the_prompt_and_answer(self):
+        self.api.params["context_length"] = 600 + 512
+        self.add_messages(2)
+        self.assertEqual(len(self.memory.window("q")), 2)
+        self.assertEqual(self.memory.window(words(580)), [])
+
+    def test_older_messages_are_summarized(self):
+        self.add_messages(5)
+        self.wait_for_summary()
+        self.assertEqual(len(self.summarizer.prompts), 1)
+        self.assertIn("m2", self.summarizer.prompts[0])
+        self.assertNotIn("m3", self.summarizer.prompts[0])
+        self.assertEqual([m.content.split()[0] for m in self.memory.messages], ["m3", "m4"])
+        window = self.memory.window("q")
+        self.assertEqual(window[0]["role"], "system")
+        self.assertTrue(window[0]["content"].endswith(f"{SUMMARY_HEADER}summary 1"))
+        self.assertEqual(self.memory.tokens_used, 7)
+
+    def test_summary_runs_off_the_critical_path(self):
+        self.summarizer.release.clear()
+        self.add_messages(6)
+        self.assertIsNotNone(self.memory.summarizing)
+        self.assertEqual(len(self.memory), 6)  # nothing is dropped before the summary lands
+        self.summarizer.release.set()
+        self.wait_for_summary()
+        self.assertEqual(self.memory.summary.content, "summary 1")
+
+    def test_clear_discards_a_running_summary(self):
+        self.summarizer.release.clear()
+        self.add_messages(5)
+        self.memory.clear()
+        self.summarizer.release.set()
+        self.wait_for_summary()
+        self.assertIsNone(self.memory.summary)
+        self.assertEqual(len(self.memory), 0)
+
+    def test_pinned_message_is_never_summarized(self):
+        self.add_messages(1)
+        pinned = self.memory.find("user", words(10, "m0"))
+        self.memory.pin(pinned)
+        self.add_messages(6, start=1)
+        self.wait_for_summary()
+        self.assertEqual(self.summarizer.prompts, [])
+        self.assertIs(self.memory.messages[0], pinned)
+
+        self.memory.pin(self.memory.find("user", words(10, "m4")))
+        self.add_messages(1, start=7)
+        self.wait_for_summary()
+        self.assertIn("m3", self.summarizer.prompts[0])
+        self.assertNotIn("m4", self.summarizer.prompts[0])
+        self.assertEqual(self.memory.messages[0].content, words(10, "m4"))
+
+    def test_find_and_holds(self):
+        memory = ConversationMemory(self.api, summarizer=self.summarizer, budget=60, summarize_at=10)
+        memory.add("user", words(10, "first"))
+        first = memory.find("user", words(10, "first"))
+        self.assertIsNotNone(first)
+        self.assertIsNone(memory.find("assistant", words(10, "first")))
+        self.assertTrue(memory.holds(first, "q"))
+        for i in range(4):
+            memory.add("assistant" if i % 2 == 0 else "user", words(10))
+        self.assertFalse(memory.holds(first, "q"))
+        self.assertFalse(memory.holds(None, "q"))
+
+
+if __name__ == "__main__":
+    unittest.main()
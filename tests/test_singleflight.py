@@ -0,0 +1,127 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from lib.llm.deadline import Deadline
+from lib.singleflight import SingleFlight, request_key
+
+
+class Generation:
+    """Fake generate() that streams a few pieces slowly and counts concurrent runs."""
+
+    def __init__(self, pieces=("a", "b", "c"), delay=0.05):
+        self.pieces = pieces
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.calls = 0
+
+    def __call__(self, publish, result=True):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            for piece in self.pieces:
+                time.sleep(self.delay)
+                publish(piece)
+            return {"text": "".join(self.pieces), "total_tokens": len(self.pieces)} if result else None
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.key = request_key("OllamaApi", "http://h", "m", "system", "prompt")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_callers(self, callers, gap=0.02):
+        """Starts callers (a list of (SingleFlight, generate)) `gap` seconds apart; returns [(result, pieces)]."""
+        results = [None] * len(callers)
+
+        def call(i, flight, generate):
+            pieces = []
+            results[i] = (flight.do(self.key, generate, on_token=pieces.append), pieces)
+
+        threads = [threading.Thread(target=call, args=(i, *caller)) for i, caller in enumerate(callers)]
+        for thread in threads:
+            thread.start()
+            time.sleep(gap)
+        for thread in threads:
+            thread.join(10.0)
+        return results
+
+    def test_threads_share_one_generation(self):
+        flight = SingleFlight(self.dir.name)
+        generation = Generation()
+        results = self.run_callers([(flight, generation)] * 3)
+        self.assertEqual(generation.calls, 1)
+        for result, pieces in results:
+            self.assertEqual((result["text"], pieces), ("abc", ["a", "b", "c"]))
+        self.assertEqual([bool(result.get("shared")) for result, _ in results], [False, True, True])
+
+    def test_processes_share_one_generation_and_clean_up(self):
+        # Separate instances only meet through the rendezvous directory, like separate processes
+        generation = Generation()
+        results = self.run_callers([(SingleFlight(self.dir.name), generation) for _ in range(3)])
+        self.assertEqual(generation.calls, 1)
+        self.assertEqual([result["text"] for result, _ in results], ["abc"] * 3)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_failed_leader_is_replaced_by_exactly_one_follower(self):
+        # The last caller arrives after the failed leader removed its lock file
+        generation = Generation()
+        failing = lambda publish: generation(publish, result=False)
+        results = self.run_callers([(SingleFlight(self.dir.name), failing),
+                                    (SingleFlight(self.dir.name), generation),
+                                    (SingleFlight(self.dir.name), generation),
+                                    (SingleFlight(self.dir.name), generation)], gap=0.06)
+        self.assertIsNone(results[0][0])
+        self.assertEqual(generation.max_running, 1)
+        self.assertEqual(generation.calls, 2)
+        self.assertEqual([result["text"] for result, _ in results[1:]], ["abc"] * 3)
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def follow_with_deadline(self, leader: SingleFlight, follower: SingleFlight, spec: str):
+        generation = Generation(delay=0.3)
+        thread = threading.Thread(target=leader.do, args=(self.key, generation))
+        thread.start()
+        time.sleep(0.05)
+        pieces = []
+        started = time.monotonic()
+        result = follower.do(self.key, generation, on_token=pieces.append, deadline=Deadline.parse(spec))
+        waited = time.monotonic() - started
+        thread.join(10.0)
+        return result, pieces, waited, generation
+
+    def test_follower_in_process_stops_at_its_deadline(self):
+        flight = SingleFlight(self.dir.name)
+        result, pieces, waited, generation = self.follow_with_deadline(flight, flight, "0.5")
+        self.assertLess(waited, 0.8)
+        self.assertEqual((result["stopped"], result["text"], pieces), ("timeout", "a", ["a"]))
+        self.assertEqual(generation.calls, 1)
+
+    def test_follower_across_processes_stops_at_its_deadline(self):
+        result, pieces, waited, generation = self.follow_with_deadline(
+            SingleFlight(self.dir.name), SingleFlight(self.dir.name), "first=0.1,total=5")
+        self.assertLess(waited, 0.5)
+        self.assertEqual((result["stopped"], result["text"], pieces), ("timeout", "", []))
+        self.assertEqual(generation.calls, 1)
+
+    def test_sequential_requests_generate_again(self):
+        generation = Generation(delay=0)
+        flight = SingleFlight(self.dir.name)
+        flight.do(self.key, generation)
+        flight.do(self.key, generation)
+        self.assertEqual(generation.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import unittest
+
+from lib.llm.stream import StreamDecoder, iter_lines, OLLAMA_TEXT_KEYS, OPENAI_TEXT_KEYS
+
+PIECES = ["Use", " `ls -la`", " to list \"all\" files", ",\n", " é and 😀", "\\n is not a newline", ""]
+
+
+def ollama_stream() -> bytes:
+    frames = [{"model": "devstral", "response": piece, "done": False} for piece in PIECES]
+    frames.append({"model": "devstral", "response": "", "done": True, "prompt_eval_count": 12, "eval_count": 7})
+    return b"".join(json.dumps(frame, separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+                    for frame in frames)
+
+
+def openai_stream() -> bytes:
+    lines = [b": keep-alive", b"event: message"]
+    for piece in PIECES:
+        chunk = {"id": "c", "object": "chat.completion.chunk",
+                 "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        lines.append(b"data: " + json.dumps(chunk, separators=(",", ":"), ensure_ascii=False).encode())
+    lines.append(b'data:{"id":"c","choices":[],"usage":{"prompt_tokens":12,"completion_tokens":7}}')
+    lines.append(b"data: [DONE]")
+    lines.append(b'data: {"after":"done"}')
+    return b"\r\n\r\n".join(lines) + b"\r\n\r\n"
+
+
+def splits(data: bytes):
+    """The stream cut in two at every byte, then in fixed-size reads."""
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+    for size in (1, 2, 3, 7, 64):
+        yield [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class IterLinesTest(unittest.TestCase):
+    def test_lines_split_across_chunks(self):
+        data = b"first\nsecond line\r\n\nthird"
+        for chunks in splits(data):
+            self.assertEqual([bytes(line) for line in iter_lines(chunks)], [b"first", b"second line", b"third"])
+
+
+class StreamDecoderTest(unittest.TestCase):
+    def decode(self, chunks, sse: bool):
+        decoder = StreamDecoder(chunks, sse=sse, text_keys=OPENAI_TEXT_KEYS if sse else OLLAMA_TEXT_KEYS)
+        pieces, frames = [], []
+        for piece, frame in decoder:
+            if piece is not None:
+                pieces.append(piece)
+            if frame is not None:
+                frames.append(frame)
+        return pieces, frames
+
+    def test_ndjson_split_at_any_byte(self):
+        for chunks in splits(ollama_stream()):
+            pieces, frames = self.decode(chunks, sse=False)
+            self.assertEqual(pieces, PIECES)
+            self.assertEqual(len(frames), 1)
+            self.assertEqual((frames[0]["prompt_eval_count"], frames[0]["eval_count"]), (12, 7))
+
+    def test_sse_split_at_any_byte(self):
+        for chunks in splits(openai_stream()):
+            pieces, frames = self.decode(chunks, sse=True)
+            self.assertEqual(pieces, PIECES)
+            self.assertEqual([frame.get("usage") for frame in frames],
+                             [{"prompt_tokens": 12, "completion_tokens": 7}])
+
+    def test_frames_are_counted(self):
+        decoder = StreamDecoder([ollama_stream()])
+        list(decoder)
+        self.assertEqual(decoder.frames, len(PIECES) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import unittest
+
+from lib.llm.basellm import BaseApiLLM
+from lib.llm.tokens import DEFAULT_COMPLETION_RESERVE
+from lib.structured import JsonFieldWatcher, build_command_prompt
+
+ANSWER = ('{"command": "grep -r \\"a, b}\\" . | head", "count": 42, "ratio": -1.5e3, '
+          '"nested": {"a": [1, {"b": "]"}], "c": null}, "flags": [true, false], '
+          '"explanation": "Searches {recursively}, then \\u00e9.", "last": true}')
+
+
+class JsonFieldWatcherTest(unittest.TestCase):
+    def feed_all(self, pieces):
+        watcher = JsonFieldWatcher()
+        completed = []
+        for piece in pieces:
+            completed.extend(watcher.feed(piece).items())
+        return watcher, completed
+
+    def test_values_split_at_any_character(self):
+        expected = json.loads(ANSWER)
+        for i in range(len(ANSWER) + 1):
+            watcher, completed = self.feed_all([ANSWER[:i], ANSWER[i:]])
+            self.assertEqual(watcher.fields, expected, f"split at {i}")
+            self.assertEqual([name for name, _ in completed], list(expected))
+
+    def test_one_character_at_a_time(self):
+        watcher, completed = self.feed_all(ANSWER)
+        self.assertEqual(dict(completed), json.loads(ANSWER))
+
+    def test_string_field_completes_at_its_closing_quote(self):
+        watcher = JsonFieldWatcher()
+        self.assertEqual(watcher.feed('{"command": "ls -'), {})
+        self.assertEqual(watcher.feed('la'), {})
+        self.assertEqual(watcher.feed('", "expl'), {"command": "ls -la"})
+        self.assertEqual(watcher.feed('anation": "Lists'), {})
+
+    def test_number_completes_at_the_next_separator(self):
+        watcher = JsonFieldWatcher()
+        self.assertEqual(watcher.feed('{"n": 12'), {})
+        self.assertEqual(watcher.feed('3'), {})
+        self.assertEqual(watcher.feed('}'), {"n": 123})
+
+
+class FakeApi(BaseApiLLM):
+    def generate_text(self, prompt, **kwargs):
+        return None
+
+
+class BuildCommandPromptTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeApi("http://fake", "fake-model")
+        self.api.params["context_length"] = 2048
+
+    def test_long_question_is_cut_not_the_instructions(self):
+        question = "".join(f"log line {i}\n" for i in range(5000)) + "why does the build fail?"
+        prompt = build_command_prompt(self.api, question, "Linux x86_64, bash")
+        self.assertTrue(prompt.startswith("Give the shell command"))
+        self.assertIn("Linux x86_64, bash", prompt)
+        self.assertIn('Answer with JSON: {"command"', prompt)
+        self.assertTrue(prompt.endswith("why does the build fail?"))
+        self.assertEqual(self.api.fit_prompt(prompt), prompt)  # sent as is, with room for the answer
+        self.assertLessEqual(self.api.count_tokens(prompt), 2048 - DEFAULT_COMPLETION_RESERVE)
+
+    def test_short_question_is_kept_whole(self):
+        prompt = build_command_prompt(self.api, "list files", "Linux")
+        self.assertTrue(prompt.endswith("\n\nlist files"))
+
+    def test_rejected_question(self):
+        self.assertIsNone(build_command_prompt(self.api, "x " * 5000, "Linux", overflow="reject"))
+
+
+if __name__ == "__main__":
+    unittest.main()
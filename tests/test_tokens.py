@@ -0,0 +1,53 @@
+import unittest
+
+from lib.llm.tokens import DEFAULT_CONTEXT_LENGTH, TokenEstimator, context_length_for, heuristic_token_count
+
+
+class ContextLengthTest(unittest.TestCase):
+    def test_longest_family_prefix_wins(self):
+        self.assertEqual(context_length_for("llama3.1:8b"), 131072)
+        self.assertEqual(context_length_for("llama3:latest"), 8192)
+        self.assertEqual(context_length_for("ai/gemma3:latest"), 131072)
+        self.assertEqual(context_length_for("gpt-4o-mini"), 128000)
+        self.assertEqual(context_length_for("gpt-4"), 8192)
+        self.assertEqual(context_length_for("unknown-model"), DEFAULT_CONTEXT_LENGTH)
+
+
+class HeuristicTest(unittest.TestCase):
+    def test_pieces(self):
+        self.assertEqual(heuristic_token_count(""), 0)
+        self.assertEqual(heuristic_token_count("Hello, world!\n"), 5)
+
+    def test_long_words_and_numbers_count_extra(self):
+        self.assertEqual(heuristic_token_count("internationalization"), 5)
+        self.assertEqual(heuristic_token_count("1234567"), 3)
+
+
+class TokenEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.estimator = TokenEstimator("no-such-model")  # no vocabulary: heuristic only
+
+    def test_calibration_moves_towards_the_reported_count(self):
+        text = "word " * 100
+        self.assertEqual(self.estimator.count(text), 100)
+        for _ in range(20):
+            self.estimator.calibrate(text, 150)
+        self.assertAlmostEqual(self.estimator.ratio, 1.5, places=2)
+        self.assertEqual(self.estimator.count(text), 150)
+
+    def test_short_texts_do_not_calibrate(self):
+        self.estimator.calibrate("a few words", 40)
+        self.assertEqual(self.estimator.ratio, 1.0)
+
+    def test_truncate_keeps_the_end(self):
+        text = "".join(f"line {i}\n" for i in range(1000)) + "the question?"
+        truncated = self.estimator.truncate(text, 300)
+        self.assertLessEqual(self.estimator.count(truncated), 300)
+        self.assertGreater(self.estimator.count(truncated), 250)
+        self.assertTrue(truncated.endswith("the question?"))
+        self.assertEqual(self.estimator.truncate("short", 300), "short")
+        self.assertEqual(self.estimator.truncate(text, 0), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
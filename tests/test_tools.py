@@ -0,0 +1,67 @@
+import time
+import unittest
+
+from lib.llm.basellm import BaseApiLLM
+from lib.tools import CommandResult, CommandRunner
+
+
+class FakeApi(BaseApiLLM):
+    def generate_text(self, prompt, **kwargs):
+        return None
+
+
+class CommandRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = CommandRunner(jobs=4, timeout=5.0)
+
+    def tearDown(self):
+        self.runner.shutdown()
+
+    def test_output_and_exit_codes_in_order(self):
+        results = self.runner.run_all(["echo one; echo two", "echo err >&2; exit 3"])
+        self.assertEqual([r.output for r in results], ["one\ntwo\n", "err\n"])
+        self.assertEqual([r.exit_code for r in results], [0, 3])
+
+    def test_commands_run_in_parallel(self):
+        started = time.monotonic()
+        self.runner.run_all(["sleep 0.5"] * 4)
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_timeout_kills_the_command_and_its_children(self):
+        runner = CommandRunner(timeout=0.5)
+        try:
+            started = time.monotonic()
+            [result] = runner.run_all(["echo started; sleep 30 & sleep 30"])
+        finally:
+            runner.shutdown()
+        self.assertLess(time.monotonic() - started, 3.0)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.output, "started\n")
+
+    def test_background_child_holding_the_output_does_not_block(self):
+        started = time.monotonic()
+        [result] = self.runner.run_all(["sleep 5 & echo done"])
+        self.assertLess(time.monotonic() - started, 3.0)
+        self.assertEqual((result.exit_code, result.timed_out, result.output), (0, False, "done\n"))
+
+
+class CommandResultTest(unittest.TestCase):
+    def test_long_output_keeps_its_end(self):
+        api = FakeApi("http://fake", "fake-model")
+        result = CommandResult("seq 5000")
+        result.output = "".join(f"{i}\n" for i in range(5000))
+        result.exit_code = 0
+        text = result.as_tool_output(api, 200)
+        self.assertTrue(text.startswith("exit code: 0\n[... start of the output omitted ...]\n"))
+        self.assertTrue(text.endswith("4999\n"))
+        self.assertLess(len(text), 2000)
+
+    def test_timed_out_status(self):
+        result = CommandResult("sleep 9")
+        result.timed_out, result.duration = True, 1.0
+        self.assertEqual(result.as_tool_output(FakeApi("http://fake", "fake-model"), 200),
+                         "exit code: None (killed after 1.0s timeout)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from lib.watch import FileWatcher
+
+
+class FileWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "app.log")
+        self.write("w", "".join(f"line {i}\n" for i in range(2000)))
+        self.watcher = FileWatcher(self.path)
+        self.watcher.load()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, mode: str, text: str, at: int | None = None):
+        with open(self.path, mode) as f:
+            if at is not None:
+                f.seek(at)
+            f.write(text)
+
+    def test_append(self):
+        self.write("a", "new 1\nnew 2\n")
+        self.assertEqual(self.watcher.read_update(), ("append", "new 1\nnew 2\n"))
+        self.write("a", "new 3\n")
+        self.assertEqual(self.watcher.read_update(), ("append", "new 3\n"))
+        self.assertEqual(self.watcher.read_update(), ("none", ""))
+
+    def test_early_edit_plus_append_is_a_diff(self):
+        self.write("r+", "LINE", at=0)
+        self.write("a", "new\n")
+        kind, text = self.watcher.read_update()
+        self.assertEqual(kind, "diff")
+        self.assertIn("-line 0\n+LINE 0\n", text)
+        self.assertIn("+new\n", text)
+
+    def test_same_size_edit_is_a_diff(self):
+        self.write("r+", "X", at=os.path.getsize(self.path) - 2)
+        kind, text = self.watcher.read_update()
+        self.assertEqual(kind, "diff")
+        self.assertIn("+line 199X\n", text)
+
+    def test_touch_is_no_change(self):
+        os.utime(self.path, ns=(1, 1))
+        self.assertEqual(self.watcher.read_update(), ("none", ""))
+
+    def test_truncate_is_a_reload(self):
+        self.write("w", "fresh\n")
+        self.assertEqual(self.watcher.read_update(), ("reload", "fresh\n"))
+
+    def test_atomic_replace_is_a_reload(self):
+        replacement = self.path + ".tmp"
+        with open(replacement, "w") as f:
+            f.write("".join(f"line {i}\n" for i in range(2000)) + "more\n")
+        os.replace(replacement, self.path)
+        kind, text = self.watcher.read_update()
+        self.assertEqual(kind, "reload")
+        self.assertTrue(text.endswith("line 1999\nmore\n"))
+
+    def test_deleted_file_is_gone_until_it_comes_back(self):
+        os.unlink(self.path)
+        self.assertEqual(self.watcher.read_update(), ("gone", ""))
+        self.write("w", "back\n")
+        self.assertEqual(self.watcher.read_update()[1], "back\n")
+
+
+if __name__ == "__main__":
+    unittest.main()